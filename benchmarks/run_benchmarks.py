@@ -0,0 +1,148 @@
+"""
+Times the instrument -> parse -> aggregate -> report pipeline on synthetic VCL and syslog traffic.
+Run it from the repository root:
+
+    python -m benchmarks.run_benchmarks --output results.json
+    python -m benchmarks.run_benchmarks --compare results.json
+"""
+import json
+import platform
+import sys
+import timeit
+import click
+from remote_code_cover import instrumentator, logs_processor, reporter
+from remote_code_cover.constants import LOG_ENCODINGS, LOG_ENCODING_LINES, LOG_MODES, LOG_MODE_SUBROUTINE
+from .traffic_generator import generate_logs
+from .vcl_generator import generate_vcls
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+RESULTS_VERSION = 1
+
+
+def measure(func, repeat):
+    """
+    Times `func` as the best of `repeat` runs, then measures its peak memory in a separate traced run.
+    Only the memory of the current process is traced, not of the report rendering processes
+    :return float, integer: seconds, peak memory in bytes (None when it cannot be measured)
+    """
+    seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+    peak_memory = None
+    if tracemalloc:
+        tracemalloc.start()
+        try:
+            func()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak_memory
+
+
+def run_benchmarks(config):
+    """
+    :param dict config: the benchmark parameters
+    :return dict: per stage, the seconds, the number of processed items, the throughput and the peak memory
+    """
+    vcls = generate_vcls(config['files'], config['subroutines'], config['subroutine_size'], config['nesting_depth'],
+                         config['synthetic_blocks'], config['seed'])
+    line_count = sum(len(vcl['content'].split('\n')) for vcl in vcls)
+    _, instrumentation_mapping = instrumentator.instrument(vcls, config['log_encoding'])
+    logs = list(generate_logs(instrumentation_mapping, config['requests'], config['log_encoding'], config['seed'],
+                              config['log_mode']))
+    aggregator = logs_processor.process_logs(
+        logs, logs_processor.CoverageAggregator(config['hit_counts'], instrumentation_mapping))
+    coverage_object = reporter.calculate_coverage(instrumentation_mapping, aggregator.covered_lines,
+                                                  aggregator.hit_counts)
+
+    stages = [
+        ('instrument', line_count, 'lines',
+         lambda: instrumentator.instrument(vcls, config['log_encoding'])),
+        ('process_logs', len(logs), 'logs',
+         lambda: logs_processor.process_logs(
+             logs, logs_processor.CoverageAggregator(config['hit_counts'], instrumentation_mapping))),
+        ('calculate_coverage', line_count, 'lines',
+         lambda: reporter.calculate_coverage(instrumentation_mapping, aggregator.covered_lines,
+                                             aggregator.hit_counts)),
+        ('generate_html_report', len(vcls), 'files',
+         lambda: reporter.generate_html_report(coverage_object)),
+    ]
+    results = {}
+    for name, items, unit, func in stages:
+        seconds, peak_memory = measure(func, config['repeat'])
+        results[name] = {
+            'seconds': seconds,
+            'items': items,
+            'unit': unit,
+            'items_per_second': items / seconds if seconds else None,
+            'peak_memory_bytes': peak_memory,
+        }
+    return results
+
+
+def compare_results(results, baseline, max_slowdown):
+    """
+    Prints the change of every stage against a baseline
+    :return bool: whether no stage got slower than `max_slowdown` times the baseline
+    """
+    passed = True
+    for name, result in sorted(results.items()):
+        baseline_result = baseline['results'].get(name)
+        if not baseline_result:
+            continue
+        ratio = result['seconds'] / baseline_result['seconds'] if baseline_result['seconds'] else 1
+        regressed = ratio > max_slowdown
+        passed = passed and not regressed
+        click.echo('{:<22} {:>9.3f}s  baseline {:>9.3f}s  x{:.2f}{}'.format(
+            name, result['seconds'], baseline_result['seconds'], ratio, '  REGRESSION' if regressed else ''))
+    return passed
+
+
+@click.command(help='Benchmark the instrument, parse, aggregate and report pipeline')
+@click.option('--files', type=int, default=10, show_default=True, help='Number of VCL files')
+@click.option('--subroutines', type=int, default=20, show_default=True, help='Subroutines per file')
+@click.option('--subroutine-size', type=int, default=50, show_default=True, help='Statements per subroutine')
+@click.option('--nesting-depth', type=int, default=3, show_default=True, help='Deepest nesting of if blocks')
+@click.option('--synthetic-blocks', type=int, default=2, show_default=True,
+              help='Block comments and long strings per subroutine')
+@click.option('--requests', type=int, default=200, show_default=True, help='Number of logged requests')
+@click.option('--log-encoding', type=click.Choice(LOG_ENCODINGS), default=LOG_ENCODING_LINES, show_default=True)
+@click.option('--log-mode', type=click.Choice(LOG_MODES), default=LOG_MODE_SUBROUTINE, show_default=True,
+              help='The logs traffic shape, a line per subroutine or per request')
+@click.option('--hit-counts', is_flag=True, help='Count the hits of every line while aggregating')
+@click.option('--repeat', type=int, default=3, show_default=True, help='Runs per stage, the fastest is kept')
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='Write the results to this json file')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='A results file to compare against')
+@click.option('--max-slowdown', type=float, default=1.2, show_default=True,
+              help='Fail the comparison when a stage is slower than this ratio of the baseline')
+def main(output, compare, max_slowdown, **config):
+    results = run_benchmarks(config)
+    for name, result in sorted(results.items()):
+        memory = result['peak_memory_bytes']
+        click.echo('{:<22} {:>9.3f}s  {:>12.0f} {}/s  peak {}'.format(
+            name, result['seconds'], result['items_per_second'] or 0, result['unit'],
+            '{:.1f}MB'.format(memory / 1024.0 / 1024) if memory is not None else 'n/a'))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'version': RESULTS_VERSION,
+                'python': platform.python_version(),
+                'config': config,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if compare:
+        with open(compare, 'r') as f:
+            baseline = json.load(f)
+        if dict(baseline.get('config', {}), repeat=None) != dict(config, repeat=None):
+            click.echo('The baseline was run with a different configuration: {}'.format(baseline.get('config')))
+        if not compare_results(results, baseline, max_slowdown):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
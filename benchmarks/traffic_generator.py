@@ -0,0 +1,47 @@
+import random
+from remote_code_cover.constants import BITMASK_GROUP_SIZE, LOG_ENCODING_BITMASK, SYSLOG_INSTRUMENTATION_NAME, \
+    LOG_MODE_REQUEST, LOG_MODE_SUBROUTINE, REQUEST_PAYLOAD_SEPARATOR
+
+SYSLOG_PREFIX = '<134>2019-03-29T00:00:00Z cache-bench {}: '.format(SYSLOG_INSTRUMENTATION_NAME)
+
+
+def get_payload(name, sub_index, covered_line_numbers, sub_tested_line_numbers, log_encoding):
+    """
+    Encodes the covered lines of a subroutine the way the instrumented code logs them
+    :return string:
+    """
+    if log_encoding == LOG_ENCODING_BITMASK:
+        covered = set(covered_line_numbers)
+        bits = sum(1 << position for position, line in enumerate(sub_tested_line_numbers) if line in covered)
+        group_count = (len(sub_tested_line_numbers) + BITMASK_GROUP_SIZE - 1) // BITMASK_GROUP_SIZE
+        # the first digit holds the lowest bits
+        return '{}:{}:{}'.format(name, sub_index, '{:0{}x}'.format(bits, group_count)[::-1])
+    return '{},{}'.format(name, ''.join('{} '.format(line) for line in covered_line_numbers))
+
+
+def generate_logs(instrumentation_mapping, request_count, log_encoding, seed=0, log_mode=LOG_MODE_SUBROUTINE):
+    """
+    Generates the syslog lines of `request_count` requests. Every request runs a random prefix of the tested
+    lines of every subroutine, so the coverage grows with the number of requests.
+    In the request log mode, every request logs a single line of the payloads of all its subroutines
+    :param dict instrumentation_mapping: as returned by `instrumentator.instrument`
+    :param integer request_count:
+    :param string log_encoding:
+    :param integer seed:
+    :param string log_mode:
+    :return generator(string):
+    """
+    rng = random.Random(seed)
+    subroutines = [(str(vcl_mapping['name_mapping']), sub_index, subroutine['tested_line_numbers'])
+                   for vcl_mapping in instrumentation_mapping.values()
+                   for sub_index, subroutine in enumerate(vcl_mapping['subroutines'])
+                   if subroutine['tested_line_numbers']]
+    for _ in range(request_count):
+        payloads = [get_payload(name, sub_index, sub_tested_line_numbers[:rng.randint(1, len(sub_tested_line_numbers))],
+                                sub_tested_line_numbers, log_encoding)
+                    for name, sub_index, sub_tested_line_numbers in subroutines]
+        if log_mode == LOG_MODE_REQUEST:
+            yield SYSLOG_PREFIX + '[INSTR] ' + REQUEST_PAYLOAD_SEPARATOR.join(payloads)
+        else:
+            for payload in payloads:
+                yield SYSLOG_PREFIX + '[INSTR] ' + payload
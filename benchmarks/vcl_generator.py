@@ -0,0 +1,70 @@
+import random
+
+
+def generate_block(lines, depth, nesting_depth, statement_count, rng):
+    """
+    Appends statements to `lines`, opening an `if` block every few statements until `nesting_depth`
+    :return None:
+    """
+    indent = '  ' * (depth + 1)
+    statements = 0
+    while statements < statement_count:
+        if depth < nesting_depth and rng.random() < 0.25:
+            lines.append('{}if (req.http.X-Bench-{} ~ "^[a-f]{}") {{'.format(indent, depth, statements))
+            nested_count = max(1, (statement_count - statements) // 2)
+            generate_block(lines, depth + 1, nesting_depth, nested_count, rng)
+            lines.append('{}}} elsif (req.http.X-Bench-{} == "{}") {{'.format(indent, depth, statements))
+            lines.append('{}  set req.http.X-Bench-Branch = "{}";'.format(indent, statements))
+            lines.append('{}}}'.format(indent))
+            statements += nested_count + 1
+        else:
+            lines.append('{}set req.http.X-Bench-{} = "value {}";'.format(indent, statements, statements))
+            statements += 1
+
+
+def generate_synthetic_block(lines, index):
+    """
+    Appends a block the instrumentation has to skip, alternating a block comment and a long string
+    """
+    if index % 2:
+        lines.append('  /* synthetic block {}'.format(index))
+        lines.append('     spanning a few lines */')
+    else:
+        lines.append('  set req.http.X-Bench-Synthetic-{} = {{"'.format(index))
+        lines.append('    synthetic block {}'.format(index))
+        lines.append('  "};')
+
+
+def generate_vcl(subroutine_count, subroutine_size, nesting_depth, synthetic_blocks, seed=0):
+    """
+    Generates a VCL file of random subroutines
+    :param integer subroutine_count:
+    :param integer subroutine_size: the number of statements in every subroutine
+    :param integer nesting_depth: the deepest nesting of `if` blocks
+    :param integer synthetic_blocks: the number of block comments and long strings in every subroutine
+    :param integer seed:
+    :return string:
+    """
+    rng = random.Random(seed)
+    lines = []
+    for sub_index in range(subroutine_count):
+        lines.append('sub bench_{} {{'.format(sub_index))
+        for block_index in range(synthetic_blocks):
+            generate_synthetic_block(lines, block_index)
+        generate_block(lines, 0, nesting_depth, subroutine_size, rng)
+        lines.append('  return(lookup);')
+        lines.append('}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def generate_vcls(file_count, subroutine_count, subroutine_size, nesting_depth, synthetic_blocks, seed=0):
+    """
+    :return list(dict): custom vcls as returned by the Fastly API
+    """
+    return [{
+        'name': 'bench_{}'.format(file_index),
+        'content': generate_vcl(subroutine_count, subroutine_size, nesting_depth, synthetic_blocks,
+                                seed + file_index),
+        'main': file_index == 0,
+    } for file_index in range(file_count)]
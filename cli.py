@@ -1,10 +1,21 @@
+import sys
 import click
-from remote_code_cover import fastly_vcl_cover
+from remote_code_cover import coverage_daemon, coverage_merger, fastly_vcl_cover, logs_collector, offline_report, \
+    overhead
+from remote_code_cover.constants import LOG_ENCODINGS, LOG_ENCODING_LINES, LOG_MODES, LOG_MODE_SUBROUTINE
+
+
+def validate_sample_rate(ctx, param, value):
+    # the pinned click has no open bounds for FloatRange, a sample rate of 0 would log nothing
+    if value == 0:
+        raise click.BadParameter('{} is not in the valid range of 0 (exclusive) to 1.'.format(value))
+    return value
 
 
 @click.command(name='fastly', help='Run test coverage on a Fastly service')
 @click.option('--fastly-token', '-t', required=True, help='Fastly api token')
-@click.option('--fastly-service-id', '-s', required=True, help='Fastly service id')
+@click.option('--fastly-service-id', '-s', 'fastly_service_ids', required=True, multiple=True,
+              help='Fastly service id, repeat it to cover many services at once')
 @click.option('--standalone-proxy', required=False, is_flag=True, help=('whether to use a standalone proxy to '
                                                                         'expose the local syslog server for '
                                                                         'incoming requests'))
@@ -13,16 +24,172 @@ from remote_code_cover import fastly_vcl_cover
 @click.option('--non-interactive', '-ni', required=False, is_flag=True,
               help='Runs the installation ignoring user input')
 @click.option('--listen-seconds', type=int, required=False, help='Listening time in seconds until stopping')
-def cover_fastly(fastly_token, fastly_service_id, standalone_proxy, proxy_remote_addr, ngrok_auth_token,
-                 non_interactive, listen_seconds):
+@click.option('--stop-when-idle', type=int, required=False,
+              help=('Stop listening once no new coverage arrived for this number of seconds, '
+                    'counted from the first instrumentation log'))
+@click.option('--daemon', required=False, is_flag=True,
+              help=('Keep the instrumented version active and ingest its logs until SIGTERM, writing a coverage '
+                    'snapshot every window, --listen-seconds limits the run'))
+@click.option('--window-seconds', type=click.IntRange(1), default=coverage_daemon.DEFAULT_WINDOW_SECONDS,
+              show_default=True, help='The length of a daemon coverage window')
+@click.option('--keep-windows', type=click.IntRange(1), default=coverage_daemon.DEFAULT_KEEP_WINDOWS,
+              show_default=True, help='The number of daemon window snapshots to keep')
+@click.option('--syslog-port', type=int, required=False, default=logs_collector.DEFAULT_SYSLOG_PORT, show_default=True,
+              help='Local TCP/UDP port the syslog server listens on')
+@click.option('--hit-counts', required=False, is_flag=True,
+              help='Count the executions of every line and report the hottest lines and subroutines')
+@click.option('--log-encoding', type=click.Choice(LOG_ENCODINGS), default=LOG_ENCODING_LINES, show_default=True,
+              help=('How covered lines are encoded in the logs, bitmask keeps the log size and the '
+                    'per request work small on long subroutines'))
+@click.option('--log-mode', type=click.Choice(LOG_MODES), default=LOG_MODE_SUBROUTINE, show_default=True,
+              help=('Log the coverage at every subroutine exit, or once per request from vcl_log or vcl_deliver, '
+                    'dividing the number of logs by the number of subroutines a request runs'))
+@click.option('--baseline-version', type=int, required=False,
+              help='Only instrument the subroutines changed since this version of the service')
+@click.option('--baseline-dir', type=click.Path(exists=True, file_okay=False), required=False,
+              help=('Only instrument the subroutines changed since this local snapshot, '
+                    'a <vcl name>.vcl file per custom vcl'))
+@click.option('--include-vcl', multiple=True,
+              help='Only instrument the custom vcls matching this name glob, or regular expression prefixed with re:')
+@click.option('--exclude-vcl', multiple=True, help='Do not instrument the custom vcls matching this name pattern')
+@click.option('--include-sub', multiple=True, help='Only instrument the subroutines matching this name pattern')
+@click.option('--exclude-sub', multiple=True, help='Do not instrument the subroutines matching this name pattern')
+@click.option('--sample-rate', type=click.FloatRange(0, 1), callback=validate_sample_rate, required=False,
+              help=('Fraction of the requests to log (over 0, up to 1), allows running the instrumentation on '
+                    'production traffic'))
+@click.option('--max-size-growth', type=float, required=False,
+              help='Fail when the instrumentation grows the VCL size by more than this percentage')
+@click.option('--max-request-log-bytes', type=int, required=False,
+              help='Fail when a request running every instrumented subroutine may log more than this number of bytes')
+@click.option('--max-sub-statements', type=int, required=False,
+              help='Fail when the instrumentation adds more than this number of statements to a subroutine')
+@click.option('--api-timeout', type=float, default=fastly_vcl_cover.REQUEST_TIMEOUT_SECONDS, show_default=True,
+              help='Seconds to wait for a Fastly API response before retrying the request')
+@click.option('--no-cache', required=False, is_flag=True,
+              help='Always instrument and upload a new version, ignoring cached instrumentation results')
+@click.option('--lcov-out', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Also export the coverage to this LCOV tracefile')
+@click.option('--cobertura-out', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Also export the coverage to this Cobertura XML file')
+@click.option('--live-port', type=int, required=False,
+              help='Serve the coverage live on this local port while listening, 0 picks a free port')
+@click.option('--summary-seconds', type=int, required=False,
+              help='Print the coverage every this number of seconds while listening')
+@click.option('--metrics-out', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Write the timings and counters of the run to this json file')
+@click.option('--metrics-textfile', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Write the timings and counters of the run to this Prometheus textfile')
+def cover_fastly(fastly_token, fastly_service_ids, standalone_proxy, proxy_remote_addr, ngrok_auth_token,
+                 non_interactive, listen_seconds, stop_when_idle, daemon, window_seconds, keep_windows, syslog_port,
+                 hit_counts, log_encoding, log_mode, baseline_version, baseline_dir, include_vcl, exclude_vcl,
+                 include_sub, exclude_sub, sample_rate, max_size_growth, max_request_log_bytes, max_sub_statements,
+                 api_timeout, no_cache, lcov_out, cobertura_out, live_port, summary_seconds, metrics_out,
+                 metrics_textfile):
     click.echo('Running coverage for fastly')
-    fastly_vcl_cover.run_coverage(fastly_token,
-                                  fastly_service_id,
-                                  standalone_proxy,
-                                  proxy_remote_addr,
-                                  ngrok_auth_token,
-                                  non_interactive,
-                                  listen_seconds)
+    succeeded = fastly_vcl_cover.run_coverage(fastly_token,
+                                              list(fastly_service_ids),
+                                              standalone_proxy,
+                                              proxy_remote_addr,
+                                              ngrok_auth_token,
+                                              non_interactive,
+                                              listen_seconds,
+                                              syslog_port=syslog_port,
+                                              hit_counts=hit_counts,
+                                              log_encoding=log_encoding,
+                                              sample_rate=sample_rate,
+                                              use_cache=not no_cache,
+                                              stop_when_idle=stop_when_idle,
+                                              lcov_out=lcov_out,
+                                              cobertura_out=cobertura_out,
+                                              live_port=live_port,
+                                              summary_seconds=summary_seconds,
+                                              metrics_out=metrics_out,
+                                              metrics_textfile=metrics_textfile,
+                                              log_mode=log_mode,
+                                              baseline_version=baseline_version,
+                                              baseline_dir=baseline_dir,
+                                              filters={
+                                                  'include_vcls': list(include_vcl),
+                                                  'exclude_vcls': list(exclude_vcl),
+                                                  'include_subroutines': list(include_sub),
+                                                  'exclude_subroutines': list(exclude_sub),
+                                              },
+                                              budgets={
+                                                  'max_size_growth_percentage': max_size_growth,
+                                                  'max_request_log_bytes': max_request_log_bytes,
+                                                  'max_subroutine_statements': max_sub_statements,
+                                              },
+                                              daemon_window_seconds=window_seconds if daemon else None,
+                                              keep_windows=keep_windows,
+                                              api_timeout=api_timeout)
+    if not succeeded:
+        sys.exit(1)
+
+
+@click.command(name='merge', help='Merge the coverage of many runs or shards into a single report')
+@click.argument('coverage_files', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--output-dir', '-o', default='coverage', show_default=True, type=click.Path(file_okay=False),
+              help='Directory of the merged report')
+@click.option('--lcov-out', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Also export the merged coverage to this LCOV tracefile')
+@click.option('--cobertura-out', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Also export the merged coverage to this Cobertura XML file')
+def merge(coverage_files, output_dir, lcov_out, cobertura_out):
+    coverage_merger.run_merge(coverage_files, output_dir, lcov_out, cobertura_out)
+
+
+@click.command(name='report', help='Build a coverage report out of syslog files, which may be rotated or compressed')
+@click.argument('log_paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--mapping', '-m', 'mapping_filename', required=True, type=click.Path(exists=True, dir_okay=False),
+              help='The instrumentation_mapping.json saved in the report directory of the run that instrumented')
+@click.option('--output-dir', '-o', default='coverage', show_default=True, type=click.Path(file_okay=False),
+              help='Directory of the report')
+@click.option('--hit-counts', required=False, is_flag=True,
+              help='Count the executions of every line and report the hottest lines and subroutines')
+@click.option('--workers', type=int, required=False, help='Number of processes parsing the logs, default: CPU count')
+@click.option('--lcov-out', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Also export the coverage to this LCOV tracefile')
+@click.option('--cobertura-out', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Also export the coverage to this Cobertura XML file')
+def report(log_paths, mapping_filename, output_dir, hit_counts, workers, lcov_out, cobertura_out):
+    offline_report.run_report(mapping_filename, log_paths, output_dir, hit_counts, workers, lcov_out, cobertura_out)
+
+
+@click.command(name='overhead', help='Report the overhead the instrumentation adds to local VCL files')
+@click.argument('vcl_paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--log-encoding', type=click.Choice(LOG_ENCODINGS), default=LOG_ENCODING_LINES, show_default=True,
+              help='How covered lines are encoded in the logs')
+@click.option('--log-mode', type=click.Choice(LOG_MODES), default=LOG_MODE_SUBROUTINE, show_default=True,
+              help='Log the coverage at every subroutine exit or once per request')
+@click.option('--sample-rate', type=click.FloatRange(0, 1), callback=validate_sample_rate, required=False,
+              help='Fraction of the requests to log')
+@click.option('--include-vcl', multiple=True,
+              help='Only instrument the custom vcls matching this name glob, or regular expression prefixed with re:')
+@click.option('--exclude-vcl', multiple=True, help='Do not instrument the custom vcls matching this name pattern')
+@click.option('--include-sub', multiple=True, help='Only instrument the subroutines matching this name pattern')
+@click.option('--exclude-sub', multiple=True, help='Do not instrument the subroutines matching this name pattern')
+@click.option('--max-size-growth', type=float, required=False,
+              help='Fail when the instrumentation grows the VCL size by more than this percentage')
+@click.option('--max-request-log-bytes', type=int, required=False,
+              help='Fail when a request running every instrumented subroutine may log more than this number of bytes')
+@click.option('--max-sub-statements', type=int, required=False,
+              help='Fail when the instrumentation adds more than this number of statements to a subroutine')
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True), required=False,
+              help='Write the overhead to this json file')
+def report_overhead(vcl_paths, log_encoding, log_mode, sample_rate, include_vcl, exclude_vcl, include_sub, exclude_sub,
+                    max_size_growth, max_request_log_bytes, max_sub_statements, output):
+    within_budgets = overhead.run_overhead(vcl_paths, log_encoding, log_mode, sample_rate, {
+        'include_vcls': list(include_vcl),
+        'exclude_vcls': list(exclude_vcl),
+        'include_subroutines': list(include_sub),
+        'exclude_subroutines': list(exclude_sub),
+    }, {
+        'max_size_growth_percentage': max_size_growth,
+        'max_request_log_bytes': max_request_log_bytes,
+        'max_subroutine_statements': max_sub_statements,
+    }, output)
+    if not within_budgets:
+        sys.exit(1)
 
 
 @click.group(help='Runs coverage analysis')
@@ -36,6 +203,9 @@ def main():
 
 
 main.add_command(cover_fastly)
+main.add_command(merge)
+main.add_command(report)
+main.add_command(report_overhead)
 
 if __name__ == '__main__':
     main()
@@ -1 +1,35 @@
 SYSLOG_INSTRUMENTATION_NAME = 'Syslog-Instrumentation'
+# the comment marking the Fastly versions rcc instrumented, followed by the instrumentation digest
+INSTRUMENTED_VERSION_COMMENT = 'rcc instrumentation'
+# bump whenever the instrumented code changes, invalidates the cached instrumentation results
+INSTRUMENTATION_CACHE_VERSION = 7
+
+LOG_ENCODING_LINES = 'lines'
+LOG_ENCODING_BITMASK = 'bitmask'
+LOG_ENCODINGS = [LOG_ENCODING_LINES, LOG_ENCODING_BITMASK]
+# number of tested lines packed into a single hex digit of a bitmask encoded log
+BITMASK_GROUP_SIZE = 4
+# request header holding the sampling decision, so all the subroutines of a request agree on it
+SAMPLING_HEADER = 'X-RCC-Sampled'
+SAMPLING_DENOMINATOR = 10000
+# the subroutine starting the request, where the rcc request headers a client sent are dropped
+REQUEST_START_SUBROUTINE = 'vcl_recv'
+# the subroutines starting a backend request, where the rcc request headers are kept from the origin
+BACKEND_REQUEST_SUBROUTINES = ('vcl_miss', 'vcl_pass')
+
+# subroutine: a log at every exit of every subroutine, request: a single log per request of all its coverage
+LOG_MODE_SUBROUTINE = 'subroutine'
+LOG_MODE_REQUEST = 'request'
+LOG_MODES = [LOG_MODE_SUBROUTINE, LOG_MODE_REQUEST]
+# request header accumulating the coverage of the request in the request log mode
+REQUEST_COVERAGE_HEADER = 'X-RCC-Coverage'
+# separates the payloads of the subroutines in a request log
+REQUEST_PAYLOAD_SEPARATOR = '|'
+# the subroutine ending the request, the first one the VCL defines is where the request log is written
+REQUEST_LOG_SUBROUTINES = ('vcl_log', 'vcl_deliver')
+# the subroutines running on the fetch node, with clustering their changes to the request do not reach the
+# delivery node, so they accumulate their coverage in a header of their own that the fetch node logs
+FETCH_SUBROUTINES = ('vcl_miss', 'vcl_pass', 'vcl_fetch')
+FETCH_COVERAGE_HEADER = 'X-RCC-Fetch-Coverage'
+# the last subroutine running on the fetch node, where the coverage of the fetch is logged
+FETCH_LOG_SUBROUTINE = 'vcl_fetch'
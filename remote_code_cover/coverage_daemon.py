@@ -0,0 +1,106 @@
+import shutil
+import signal
+import threading
+import time
+from os import path, listdir
+from . import exporters
+from .utils import cli_util, fs_util
+
+# the directory under every report directory holding the coverage snapshot of every window
+WINDOWS_DIR = 'windows'
+# window snapshots are named by the UTC time the window ended at and their sequence number in the run,
+# so they sort chronologically and windows ending within the same second do not collide
+WINDOW_NAME_FORMAT = '%Y%m%dT%H%M%SZ'
+WINDOW_SEQUENCE_FORMAT = '{}-{:06d}'
+DEFAULT_WINDOW_SECONDS = 3600
+DEFAULT_KEEP_WINDOWS = 168
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def install_stop_signals(stop_event):
+    """
+    Sets `stop_event` on SIGTERM and SIGINT instead of exiting, so the run can wind down and roll back.
+    Signal handlers can only be installed from the main thread, elsewhere the signals keep their handlers
+    :param threading.Event stop_event:
+    :return dict: the previous handlers, to restore with `restore_signals`
+    """
+    if threading.current_thread().name != 'MainThread':
+        return {}
+
+    def handle_signal(signum, _):
+        cli_util.important('Received signal {}, stopping after the current window..'.format(signum))
+        stop_event.set()
+
+    return dict((signum, signal.signal(signum, handle_signal)) for signum in STOP_SIGNALS)
+
+
+def restore_signals(previous_handlers):
+    """
+    :param dict previous_handlers: as returned by `install_stop_signals`
+    :return None:
+    """
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+
+
+def get_window_name(window_end, sequence):
+    """
+    :param float window_end: a timestamp
+    :param integer sequence: the number of the window in the run
+    :return string:
+    """
+    return WINDOW_SEQUENCE_FORMAT.format(time.strftime(WINDOW_NAME_FORMAT, time.gmtime(window_end)), sequence)
+
+
+def write_window_snapshot(coverage_object, base_path, window_name, keep_windows=DEFAULT_KEEP_WINDOWS):
+    """
+    Writes the coverage of a window as a coverage.json under `<base path>/windows/<window name>`, which
+    `rcc merge` can combine over any range of windows, and deletes the oldest windows beyond `keep_windows`.
+    The windows share the sources of the report directory rather than copying them
+    :param dict coverage_object:
+    :param string base_path: the report directory
+    :param string window_name:
+    :param integer keep_windows: optional - the number of windows to keep, all of them when not set
+    :return string: the window directory
+    """
+    window_path = path.join(base_path, WINDOWS_DIR, window_name)
+    fs_util.mkdirp(window_path)
+    exporters.write_coverage_json(coverage_object, window_path, path.join(base_path, exporters.SOURCES_DIR))
+    if keep_windows:
+        windows_path = path.join(base_path, WINDOWS_DIR)
+        for old_window_name in sorted(listdir(windows_path))[:-keep_windows]:
+            shutil.rmtree(path.join(windows_path, old_window_name), ignore_errors=True)
+    return window_path
+
+
+def run_windows(aggregator, window_seconds, on_window, stop_event, deadline=None, cumulative_aggregator=None):
+    """
+    Cuts the incoming coverage into windows until `stop_event` is set or the deadline passed.
+    At the end of every window the coverage of the window is taken out of the aggregator and handed to
+    `on_window`, so the aggregator only ever holds a single window
+    :param logs_processor.CoverageAggregator aggregator: receives the incoming logs
+    :param float window_seconds:
+    :param function on_window: called with the aggregated results of the window, see
+    `CoverageAggregator.get_results`, the window start and end times and the window sequence number
+    :param threading.Event stop_event:
+    :param float deadline: optional - the time to stop at
+    :param logs_processor.CoverageAggregator cumulative_aggregator: optional - accumulates the coverage of all
+    the windows, the results of a window are moved into it at once
+    :return None:
+    """
+    cli_util.output('Writing a coverage snapshot every {} seconds until stopped'.format(window_seconds))
+    sequence = 0
+    while True:
+        window_start = time.time()
+        window_end = window_start + window_seconds
+        if deadline is not None:
+            window_end = min(window_end, deadline)
+        stopped = stop_event.wait(max(window_end - time.time(), 0))
+        try:
+            on_window(aggregator.pop_results(cumulative_aggregator), window_start, time.time(), sequence)
+        except Exception as err:
+            # a failing snapshot, e.g. a full disk, must not stop the coverage of the next windows
+            cli_util.error('Failed writing the coverage snapshot: {}'.format(err))
+        if stopped or (deadline is not None and time.time() >= deadline):
+            return
+        sequence += 1
@@ -0,0 +1,139 @@
+import json
+from collections import Counter
+from os import path
+from . import exporters, reporter
+from .utils import bitset_util, cli_util, fs_util
+
+COVERAGE_JSON_NAME = 'coverage.json'
+
+
+def resolve_coverage_file(filename):
+    """
+    :param string filename: a coverage.json file or a report directory containing one
+    :return string:
+    """
+    if path.isdir(filename):
+        return path.join(filename, COVERAGE_JSON_NAME)
+    return filename
+
+
+class CoverageMerger:
+    """
+    Unions the coverage of many coverage.json files, one file at a time.
+    Files are keyed by their name and source hash, so only the coverage of the same source is combined.
+    Only bitsets and hit counters are kept in memory, the sources are read once all the files were added
+    """
+
+    def __init__(self):
+        self.tested_lines = {}
+        self.covered_lines = {}
+        self.hit_counts = {}
+        self.subroutines = {}
+        self.source_paths = {}
+        self.sample_rates = set()
+        self.merged_file_count = 0
+        # hit counts are only reported when every merged result counted them
+        self.all_counted_hits = True
+
+    def add_coverage_file(self, filename):
+        """
+        :param string filename: a coverage.json file or a report directory containing one
+        :return None:
+        """
+        filename = resolve_coverage_file(filename)
+        with open(filename, 'r') as f:
+            coverage = json.load(f)
+        if coverage.get('version') != exporters.COVERAGE_JSON_VERSION:
+            raise Exception('Unsupported coverage file {}, re-run it with this version of rcc'.format(filename))
+
+        sources_path = path.join(path.dirname(filename), coverage.get('sources_dir', exporters.SOURCES_DIR))
+        for name, file_coverage in coverage['files'].items():
+            key = (name, file_coverage['source_hash'])
+            covered = bitset_util.from_line_numbers(file_coverage['covered_line_numbers'])
+            tested = covered | bitset_util.from_line_numbers(file_coverage['uncovered_line_numbers'])
+            self.tested_lines[key] = self.tested_lines.get(key, 0) | tested
+            self.covered_lines[key] = self.covered_lines.get(key, 0) | covered
+            self.source_paths.setdefault(key, path.join(sources_path, file_coverage['source_hash'] + '.vcl'))
+            if 'hit_counts' in file_coverage:
+                counter = self.hit_counts.setdefault(key, Counter())
+                counter.update(dict((int(line), hits) for line, hits in file_coverage['hit_counts'].items()))
+                self.subroutines.setdefault(key, file_coverage['subroutines'])
+            else:
+                self.all_counted_hits = False
+
+        self.sample_rates.add(coverage.get('metadata', {}).get('sample_rate'))
+        self.merged_file_count += 1
+
+    def get_display_names(self):
+        """
+        A name covered with more than one source is suffixed with the source hash prefix
+        :return dict: key: (name, source hash), value: the name to report it under
+        """
+        name_counts = Counter(name for name, _ in self.tested_lines)
+        return dict(((name, source_hash), name if name_counts[name] == 1 else '{}-{}'.format(name, source_hash[:8]))
+                    for name, source_hash in self.tested_lines)
+
+    def get_subroutines(self, key, tested_line_numbers):
+        """
+        The subroutines of a file with their tested lines, the lines of a subroutine are the ones up to the next one
+        :return list(dict):
+        """
+        subroutines = sorted(self.subroutines.get(key, []), key=lambda sub: sub['line_number'])
+        result = []
+        for index, subroutine in enumerate(subroutines):
+            end = subroutines[index + 1]['line_number'] if index + 1 < len(subroutines) else float('inf')
+            result.append({
+                'name': subroutine['name'],
+                'line_number': subroutine['line_number'],
+                'tested_line_numbers': [line for line in tested_line_numbers
+                                        if subroutine['line_number'] <= line < end],
+            })
+        return result
+
+    def calculate_coverage(self):
+        """
+        :return dict: the coverage object of the merged results
+        """
+        instrumentation_mappings = {}
+        covered_lines = {}
+        hit_counts = {} if self.all_counted_hits else None
+        for index, (key, display_name) in enumerate(sorted(self.get_display_names().items(), key=lambda i: i[1])):
+            tested_line_numbers = bitset_util.to_line_numbers(self.tested_lines[key])
+            instrumentation_mappings[display_name] = {
+                'original_content': fs_util.read_file(self.source_paths[key]),
+                'tested_line_numbers': tested_line_numbers,
+                'tested_line_count': len(tested_line_numbers),
+                'subroutines': self.get_subroutines(key, tested_line_numbers),
+                'name_mapping': index,
+            }
+            covered_lines[str(index)] = self.covered_lines[key]
+            if hit_counts is not None:
+                hit_counts[str(index)] = self.hit_counts[key]
+
+        metadata = {'merged_results': self.merged_file_count}
+        if len(self.sample_rates) == 1:
+            metadata['sample_rate'] = next(iter(self.sample_rates))
+        return reporter.calculate_coverage(instrumentation_mappings, covered_lines, hit_counts, metadata=metadata)
+
+
+def run_merge(coverage_files, output_dir=reporter.REPORT_DIR, lcov_out=None, cobertura_out=None):
+    """
+    Merges the coverage of many runs or shards into a single report
+    :param list(string) coverage_files: coverage.json files or report directories containing one
+    :param string output_dir: the directory of the merged report
+    :param string lcov_out: optional - a file to export the merged coverage to in the LCOV format
+    :param string cobertura_out: optional - a file to export the merged coverage to in the Cobertura format
+    :return None:
+    """
+    try:
+        merger = CoverageMerger()
+        for filename in coverage_files:
+            merger.add_coverage_file(filename)
+        coverage_object = merger.calculate_coverage()
+        cli_util.output('Merged {} coverage results, {}% line coverage'.format(
+            merger.merged_file_count, coverage_object['global']['coverage_line_percentage']))
+
+        reporter.write_report(coverage_object, output_dir, lcov_out, cobertura_out)
+
+    except Exception as err:
+        cli_util.exception_format(err)
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import time
+from os import path
+from xml.sax.saxutils import quoteattr
+from .utils import fs_util
+
+COVERAGE_JSON_VERSION = 1
+SOURCES_DIR = 'sources'
+# the covered lines are counted once when the hits were not counted
+DEFAULT_COVERED_HITS = 1
+
+
+def source_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def get_line_hits(file_coverage):
+    """
+    :param dict file_coverage:
+    :return list(tuple(integer, integer)): the line number and hits of every tested line, ordered by line number
+    """
+    hit_counts = file_coverage.get('hit_counts')
+    covered_line_numbers = set(file_coverage['covered_line_numbers'])
+    line_hits = []
+    for line in file_coverage['tested_line_numbers']:
+        if line not in covered_line_numbers:
+            line_hits.append((line, 0))
+        elif hit_counts is None:
+            line_hits.append((line, DEFAULT_COVERED_HITS))
+        else:
+            line_hits.append((line, hit_counts[line]))
+    return line_hits
+
+
+def get_slim_file_coverage(file_coverage):
+    """
+    The coverage of a file without its source, which is referenced by hash.
+    The tested lines are the union of the covered and the uncovered lines
+    :param dict file_coverage:
+    :return dict:
+    """
+    slim = {
+        'source_hash': source_hash(file_coverage['original_content']),
+        'coverage_line_percentage': file_coverage['coverage_line_percentage'],
+        'covered_line_count': file_coverage['covered_line_count'],
+        'tested_line_count': file_coverage['tested_line_count'],
+        'total_line_count': file_coverage['total_line_count'],
+        'covered_line_numbers': file_coverage['covered_line_numbers'],
+        'uncovered_line_numbers': file_coverage['uncovered_line_numbers'],
+    }
+    if 'hit_counts' in file_coverage:
+        slim['hit_counts'] = file_coverage['hit_counts']
+        slim['subroutines'] = file_coverage['subroutines']
+    return slim
+
+
+def write_sources(coverage_object, sources_path):
+    """
+    Writes the source of every file once, named by its hash
+    :param dict coverage_object:
+    :param string sources_path: the sources directory
+    :return None:
+    """
+    fs_util.mkdirp(sources_path)
+    for file_coverage in coverage_object['files'].values():
+        filename = path.join(sources_path, source_hash(file_coverage['original_content']) + '.vcl')
+        if not path.exists(filename):
+            fs_util.write_file(filename, file_coverage['original_content'])
+
+
+def write_coverage_json(coverage_object, base_path, sources_path=None):
+    """
+    Writes a compact coverage.json, the sources are written next to it under `sources/<hash>.vcl`
+    :param dict coverage_object:
+    :param string base_path: the report directory
+    :param string sources_path: optional - a sources directory shared with other reports, referenced from the
+    coverage.json by its path relative to the report directory
+    :return None:
+    """
+    write_sources(coverage_object, sources_path or path.join(base_path, SOURCES_DIR))
+    slim_coverage = {
+        'version': COVERAGE_JSON_VERSION,
+        'global': coverage_object['global'],
+        'metadata': coverage_object.get('metadata', {}),
+        'files': dict((name, get_slim_file_coverage(file_coverage))
+                      for name, file_coverage in coverage_object['files'].items()),
+    }
+    for key in ('hottest_lines', 'hottest_subroutines'):
+        if key in coverage_object:
+            slim_coverage[key] = coverage_object[key]
+    if sources_path:
+        slim_coverage['sources_dir'] = path.relpath(sources_path, base_path)
+    with open(path.join(base_path, 'coverage.json'), 'w') as f:
+        json.dump(slim_coverage, f, separators=(',', ':'))
+
+
+def get_subroutine_calls(subroutines, line_hits):
+    """
+    Estimates the number of calls of every subroutine as the hits of its most executed line,
+    the lines of a subroutine are the ones up to the next subroutine
+    :param list(dict) subroutines: ordered by line number
+    :param list(tuple(integer, integer)) line_hits: the line number and hits of every tested line
+    :return list(integer): the calls of every subroutine, in order
+    """
+    calls = [0] * len(subroutines)
+    sub_index = -1
+    for line, hits in line_hits:
+        while sub_index + 1 < len(subroutines) and subroutines[sub_index + 1]['line_number'] <= line:
+            sub_index += 1
+        if sub_index >= 0:
+            calls[sub_index] = max(calls[sub_index], hits)
+    return calls
+
+
+def write_lcov(coverage_object, filename):
+    """
+    Writes the coverage in the LCOV tracefile format, file by file
+    :param dict coverage_object:
+    :param string filename:
+    :return None:
+    """
+    with open(filename, 'w') as f:
+        for name in sorted(coverage_object['files']):
+            file_coverage = coverage_object['files'][name]
+            f.write('TN:\nSF:{}.vcl\n'.format(name))
+            line_hits = get_line_hits(file_coverage)
+            if 'subroutines' in file_coverage:
+                subroutine_calls = get_subroutine_calls(file_coverage['subroutines'], line_hits)
+                for subroutine in file_coverage['subroutines']:
+                    f.write('FN:{},{}\n'.format(subroutine['line_number'], subroutine['name']))
+                for subroutine, calls in zip(file_coverage['subroutines'], subroutine_calls):
+                    f.write('FNDA:{},{}\n'.format(calls, subroutine['name']))
+                f.write('FNF:{}\nFNH:{}\n'.format(len(subroutine_calls),
+                                                  sum(1 for calls in subroutine_calls if calls)))
+            for line, hits in line_hits:
+                f.write('DA:{},{}\n'.format(line, hits))
+            f.write('LF:{}\nLH:{}\nend_of_record\n'.format(file_coverage['tested_line_count'],
+                                                           file_coverage['covered_line_count']))
+
+
+def line_rate(file_or_global_coverage):
+    return '{:.4f}'.format(file_or_global_coverage['coverage_line_percentage'] / 100.0)
+
+
+def write_cobertura(coverage_object, filename):
+    """
+    Writes the coverage as a Cobertura XML report, file by file.
+    Every vcl is a class of a single `vcl` package, VCL has no branch coverage
+    :param dict coverage_object:
+    :param string filename:
+    :return None:
+    """
+    global_coverage = coverage_object['global']
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" ?>\n'
+                '<!DOCTYPE coverage SYSTEM "http://cobertura.sourceforge.net/xml/coverage-04.dtd">\n')
+        f.write('<coverage line-rate="{}" branch-rate="0" lines-covered="{}" lines-valid="{}" branches-covered="0" '
+                'branches-valid="0" complexity="0" version="rcc" timestamp="{}">\n'.format(
+                    line_rate(global_coverage), global_coverage['covered_line_count'],
+                    global_coverage['tested_line_count'], int(time.time() * 1000)))
+        f.write('<sources><source>.</source></sources>\n<packages>\n')
+        f.write('<package name="vcl" line-rate="{}" branch-rate="0" complexity="0">\n<classes>\n'.format(
+            line_rate(global_coverage)))
+        for name in sorted(coverage_object['files']):
+            file_coverage = coverage_object['files'][name]
+            f.write('<class name={} filename={} line-rate="{}" branch-rate="0" complexity="0">\n'
+                    '<methods/>\n<lines>\n'.format(quoteattr(name), quoteattr(name + '.vcl'),
+                                                   line_rate(file_coverage)))
+            for line, hits in get_line_hits(file_coverage):
+                f.write('<line number="{}" hits="{}" branch="false"/>\n'.format(line, hits))
+            f.write('</lines>\n</class>\n')
+        f.write('</classes>\n</package>\n</packages>\n</coverage>\n')
@@ -1,33 +1,128 @@
+import threading
+import time
 from os import path
-import os
-from .utils.fastly_api_util import FastlyApiClient
-from .utils import fs_util, cli_util
-from . import instrumentator, logs_collector, logs_processor, reporter
-from .constants import SYSLOG_INSTRUMENTATION_NAME
+from .utils.fastly_api_util import FastlyApiClient, REQUEST_TIMEOUT_SECONDS
+from .utils import fs_util, cli_util, cache_util, concurrency_util, metrics_util
+from . import coverage_daemon, instrumentator, live_view, logs_collector, logs_processor, overhead, reporter
+from .constants import SYSLOG_INSTRUMENTATION_NAME, INSTRUMENTED_VERSION_COMMENT, LOG_ENCODING_LINES, \
+    LOG_MODE_SUBROUTINE
 
+# the number of custom vcls uploaded concurrently
+UPLOAD_WORKERS = 8
+# the options of a coverage run with their defaults, passed to `run_coverage` by name only
+RUN_OPTIONS = {
+    'syslog_port': logs_collector.DEFAULT_SYSLOG_PORT,
+    'hit_counts': False,
+    'log_encoding': LOG_ENCODING_LINES,
+    'sample_rate': None,
+    'use_cache': True,
+    'stop_when_idle': None,
+    'lcov_out': None,
+    'cobertura_out': None,
+    'live_port': None,
+    'summary_seconds': None,
+    'metrics_out': None,
+    'metrics_textfile': None,
+    'log_mode': LOG_MODE_SUBROUTINE,
+    'baseline_version': None,
+    'baseline_dir': None,
+    'filters': None,
+    'budgets': None,
+    'daemon_window_seconds': None,
+    'keep_windows': coverage_daemon.DEFAULT_KEEP_WINDOWS,
+    'api_timeout': REQUEST_TIMEOUT_SECONDS,
+}
 
-def upload_instrumented_version(fastly_client, proxy_remote_addr):
+
+def get_instrumentation_digest(active_version, instr_vcls, proxy_remote_addr):
+    """
+    :return string: a hash identifying an instrumented version by everything it is made of
+    """
+    vcl_hashes = sorted([vcl['name'], bool(vcl['main']), cache_util.content_hash(vcl['content'])]
+                        for vcl in instr_vcls)
+    return cache_util.content_hash(active_version, proxy_remote_addr, vcl_hashes)
+
+
+def find_version_by_comment(versions, comment):
+    for version_obj in versions:
+        if version_obj.get('comment') == comment:
+            return version_obj['number']
+    return None
+
+
+def upload_instrumented_version(fastly_client, proxy_remote_addr, log_encoding=LOG_ENCODING_LINES, sample_rate=None,
+                                cache_dir=None, name_prefix='', log_mode=LOG_MODE_SUBROUTINE, baseline_version=None,
+                                baseline_dir=None, filters=None, budgets=None):
     """
-    Retrieves active version, instruments it and uploads it as a draft version
+    Retrieves active version, instruments it and uploads it as a draft version.
+    When caching, a version previously uploaded with the same instrumentation is reused instead,
+    and only the custom vcls that the instrumentation changed are uploaded.
+    Given a baseline, only the subroutines that changed since it are instrumented, and given filters only the
+    vcls and subroutines they include.
+    The overhead of the instrumentation is printed, and nothing is uploaded when it exceeds the budgets
     :param fastly_api_cover.utils.fastly_api_util.FastlyApiClient fastly_client:
     :param string proxy_remote_addr: the remote addr to send syslogs to
-    :return integer, integer, dict:
+    :param string log_encoding: how covered lines are encoded in the logs
+    :param float sample_rate: optional - the fraction of requests to log
+    :param string cache_dir: optional - the instrumentation cache directory, no caching when not set
+    :param string name_prefix: optional - prefixes the logged names of the service
+    :param string log_mode: whether to log at every subroutine exit or once per request
+    :param integer baseline_version: optional - a version of the service to compare the active version to
+    :param string baseline_dir: optional - a local snapshot to compare the active version to,
+    a `<vcl name>.vcl` file per custom vcl
+    :param dict filters: optional - vcl and subroutine name patterns, see `instrumentator.filter_subroutines`
+    :param dict budgets: optional - limits of the instrumentation overhead, see `overhead.check_budgets`
+    :return integer, integer, dict, dict: the active and instrumented versions, the instrumentation mapping
+    and the overhead of the instrumentation
     """
     cli_util.output('Retrieving active version custom vcls')
-    active_version = fastly_client.get_active_version()
+    versions = fastly_client.get_versions()
+    active_version = fastly_client.get_active_version(versions)
     custom_vcls = fastly_client.get_all_custom_vcls(active_version)
 
+    changed_subroutines = None
+    if baseline_version or baseline_dir:
+        baseline_vcls = fastly_client.get_all_custom_vcls(baseline_version) if baseline_version \
+            else instrumentator.read_vcl_files([baseline_dir])
+        changed_subroutines = instrumentator.get_changed_subroutines(custom_vcls, baseline_vcls)
+        changed_count = sum(len(names) for names in changed_subroutines.values())
+        if not changed_count:
+            raise Exception('No subroutine changed since the baseline, nothing to cover')
+        cli_util.output('Instrumenting the {} subroutines changed since the baseline'.format(changed_count))
+    instrumented_subroutines = instrumentator.filter_subroutines(custom_vcls, filters, changed_subroutines)
+    if instrumented_subroutines is not None and not any(instrumented_subroutines.values()):
+        raise Exception('The filters exclude every subroutine, nothing to cover')
+
     cli_util.output('Applying instrumentation on code..')
-    instr_vcls, instrumentation_mapping = instrumentator.instrument(custom_vcls)
+    with metrics_util.registry.phase('instrument'):
+        instr_vcls, instrumentation_mapping = instrumentator.instrument(custom_vcls, log_encoding, sample_rate,
+                                                                        cache_dir, name_prefix, log_mode,
+                                                                        instrumented_subroutines)
+    instrumentation_overhead = overhead.calculate_overhead(custom_vcls, instr_vcls, instrumentation_mapping,
+                                                           log_encoding, log_mode, sample_rate)
+    overhead.enforce_budgets(instrumentation_overhead, budgets)
+
+    version_comment = '{} {}'.format(INSTRUMENTED_VERSION_COMMENT,
+                                     get_instrumentation_digest(active_version, instr_vcls, proxy_remote_addr))
+    instrumented_version = find_version_by_comment(versions, version_comment) if cache_dir else None
+    if instrumented_version:
+        cli_util.output('Reusing the unchanged instrumented version {}'.format(instrumented_version))
+        return active_version, instrumented_version, instrumentation_mapping, instrumentation_overhead
 
     draft_version = fastly_client.clone_version(active_version)
     cli_util.output('Uploading custom vcls to draft version {}'.format(draft_version))
-    for instr_vcl in instr_vcls:
+    original_contents = dict((vcl['name'], vcl['content']) for vcl in custom_vcls)
+    # when nothing was instrumented, the draft already holds this content
+    changed_vcls = [vcl for vcl in instr_vcls if vcl['content'] != original_contents[vcl['name']]]
+
+    def upload_custom_vcl(instr_vcl):
         is_main = 'true' if instr_vcl['main'] else 'false'
         vcl_to_upload = {'name': instr_vcl['name'], 'content': instr_vcl['content'], 'main': is_main}
         fastly_client.delete_custom_vcl(draft_version, vcl_to_upload['name'])
         fastly_client.create_custom_vcl(draft_version, vcl_to_upload)
 
+    concurrency_util.parallel_map(upload_custom_vcl, changed_vcls, UPLOAD_WORKERS)
+
     fastly_client.delete_syslog(draft_version, SYSLOG_INSTRUMENTATION_NAME)
     address, port = proxy_remote_addr.split(':')
     fastly_client.create_syslog(draft_version, {
@@ -36,59 +131,248 @@ def upload_instrumented_version(fastly_client, proxy_remote_addr):
         'hostname': address,
         'port': port,
     })
+    fastly_client.update_version(draft_version, {'comment': version_comment})
+
+    return active_version, draft_version, instrumentation_mapping, instrumentation_overhead
 
-    return active_version, draft_version, instrumentation_mapping
 
+def get_service_output_path(output_path, service_id, multiple_services):
+    """
+    With many services, every service gets its own output, suffixed with its id
+    :param string output_path: optional
+    :return string:
+    """
+    if not output_path or not multiple_services:
+        return output_path
+    base, extension = path.splitext(output_path)
+    return '{}-{}{}'.format(base, service_id, extension)
 
-def run_coverage(fastly_token, fastly_service_id, standalone_proxy, proxy_remote_addr, ngrok_auth_token,
-                 non_interactive, listen_seconds=None):
+
+def get_service_base_path(service_id, multiple_services):
+    """
+    :return string: the report directory of a service
+    """
+    return path.join(reporter.REPORT_DIR, service_id) if multiple_services else reporter.REPORT_DIR
+
+
+def write_service_reports(services, aggregator, multiple_services, metadata=None, lcov_out=None, cobertura_out=None):
+    """
+    Writes the report of every service, with its instrumentation mapping and overhead
+    :param list(dict) services:
+    :param logs_processor.CoverageAggregator aggregator: the coverage of all the services
+    :param bool multiple_services:
+    :param dict metadata: optional - properties of the run to show in the reports
+    :param string lcov_out: optional
+    :param string cobertura_out: optional
+    :return list(string): the path of every report index
+    """
+    index_paths = []
+    for service in services:
+        service_id = service['service_id']
+        coverage_object = reporter.calculate_coverage(service['instrumentation_mapping'], aggregator.covered_lines,
+                                                      aggregator.hit_counts,
+                                                      metadata=dict(metadata or {}, service_id=service_id))
+        base_path = get_service_base_path(service_id, multiple_services)
+        with metrics_util.registry.phase('report'):
+            index_paths.append(reporter.write_report(
+                coverage_object, base_path, get_service_output_path(lcov_out, service_id, multiple_services),
+                get_service_output_path(cobertura_out, service_id, multiple_services)))
+        # allows building coverage out of logs collected elsewhere with `rcc report`
+        instrumentator.write_mapping(service['instrumentation_mapping'],
+                                     path.join(base_path, instrumentator.MAPPING_FILE_NAME))
+        overhead.write_overhead(service['overhead'], path.join(base_path, overhead.OVERHEAD_FILE_NAME))
+        metrics_util.registry.set_gauge('coverage_line_percentage',
+                                        coverage_object['global']['coverage_line_percentage'],
+                                        labels={'service': service_id})
+    return index_paths
+
+
+def write_window_snapshots(services, window_aggregator, multiple_services, window_start, window_end, sequence,
+                           metadata=None, keep_windows=coverage_daemon.DEFAULT_KEEP_WINDOWS):
+    """
+    Writes the coverage of a single window of every service
+    :param list(dict) services:
+    :param logs_processor.CoverageAggregator window_aggregator: the coverage of the window
+    :param bool multiple_services:
+    :param float window_start:
+    :param float window_end:
+    :param integer sequence: the number of the window in the run
+    :param dict metadata: optional - properties of the run
+    :param integer keep_windows: optional - the number of windows to keep of every service
+    :return None:
+    """
+    window_name = coverage_daemon.get_window_name(window_end, sequence)
+    for service in services:
+        service_id = service['service_id']
+        coverage_object = reporter.calculate_coverage(
+            service['instrumentation_mapping'], window_aggregator.covered_lines, window_aggregator.hit_counts,
+            metadata=dict(metadata or {}, service_id=service_id, window_start=window_start, window_end=window_end))
+        coverage_daemon.write_window_snapshot(coverage_object, get_service_base_path(service_id, multiple_services),
+                                              window_name, keep_windows)
+    cli_util.output('Window {}: {} instrumentation logs'.format(window_name, window_aggregator.message_count))
+
+
+def run_coverage(fastly_token, fastly_service_ids, standalone_proxy, proxy_remote_addr, ngrok_auth_token,
+                 non_interactive, listen_seconds=None, **options):
     """
     1. Instrument vcl code
     2. Deploy it (including Px-Instrumentation syslog)
     3. Run a local ngrok (if standalone_proxy is False) or use standalone
     4. Run a local syslog server as an upstream of ngrok endpoint (listening for logs output)
     (Run end-to-end tests externally on the deployed website - the process will capture the logs output)
-    5. When tests finished, parse the logs into instrumentation result in instrumentation report
+    5. Aggregate the logs into the instrumentation result as they arrive, and when tests finished
+    turn it into an instrumentation report
     6. Display the report
-    :return None:
+    Many services are covered at once through the same syslog server, the logged names of every service are
+    prefixed so the logs are told apart, and every service gets its own report under `coverage/<service id>`
+    When `hit_counts` is set, the number of executions of every line is counted and the hottest lines are reported
+    When `sample_rate` is set, only that fraction of the requests is logged
+    When `stop_when_idle` is set, listening stops once no new coverage arrived for that number of seconds
+    When `use_cache` is set, instrumentation results are cached and unchanged instrumented versions are reused
+    When `lcov_out` or `cobertura_out` are set, the coverage is exported to these files as well
+    When `live_port` is set, the coverage is served live on that local port while listening,
+    and when `summary_seconds` is set it is printed every that number of seconds
+    When `metrics_out` or `metrics_textfile` are set, the timings and counters of the run are written to them,
+    as json and as a Prometheus textfile
+    When `log_mode` is request, every request logs its coverage once instead of at every subroutine exit
+    When `baseline_version` or `baseline_dir` are set, only the subroutines changed since that version of the
+    service or that local snapshot are instrumented and reported
+    When `filters` are set, only the vcls and subroutines whose names they include are instrumented
+    The overhead of the instrumentation is written next to every report, and when it exceeds the `budgets`
+    nothing is activated
+    When `daemon_window_seconds` is set, runs as a daemon until SIGTERM or SIGINT, or `listen_seconds`: the logs
+    are ingested continuously, the coverage of every window of that number of seconds is written under
+    `coverage/windows`, keeping the last `keep_windows` of them, and the report is updated every window
+    Every Fastly API request fails after `api_timeout` seconds without a response, and is retried when idempotent
+    :param list(string) fastly_service_ids:
+    :param dict options: keyword only, see `RUN_OPTIONS`
+    :return bool: whether the run succeeded, it fails e.g. when the overhead exceeds the budgets
     """
+    unknown_options = sorted(set(options) - set(RUN_OPTIONS))
+    if unknown_options:
+        raise TypeError('Unknown coverage run options: {}'.format(', '.join(unknown_options)))
+    options = dict(RUN_OPTIONS, **options)
+    hit_counts = options['hit_counts']
+    daemon_window_seconds = options['daemon_window_seconds']
 
+    succeeded = False
+    stop_event = threading.Event()
+    previous_signal_handlers = coverage_daemon.install_stop_signals(stop_event) if daemon_window_seconds else {}
     try:
         cli_util.set_interactive(not non_interactive)
+        if isinstance(fastly_service_ids, str):
+            fastly_service_ids = [fastly_service_ids]
+        multiple_services = len(fastly_service_ids) > 1
+        cache_dir = cache_util.get_default_cache_dir() if options['use_cache'] else None
+        if options['baseline_version'] and options['baseline_dir']:
+            raise Exception('Compare to either a baseline version or a baseline directory, not both')
+        baseline = 'version {}'.format(options['baseline_version']) if options['baseline_version'] \
+            else options['baseline_dir']
+        metadata = {'sample_rate': options['sample_rate'], 'baseline': baseline}
+
+        def upload_service(indexed_service_id):
+            index, service_id = indexed_service_id
+            fastly_client = FastlyApiClient(fastly_token, service_id, timeout=options['api_timeout'])
+            name_prefix = 's{}-'.format(index) if multiple_services else ''
+            active_version, draft_version, instrumentation_mapping, instrumentation_overhead = \
+                upload_instrumented_version(fastly_client, proxy_remote_addr, options['log_encoding'],
+                                            options['sample_rate'], cache_dir, name_prefix, options['log_mode'],
+                                            options['baseline_version'], options['baseline_dir'], options['filters'],
+                                            options['budgets'])
+            return {
+                'service_id': service_id,
+                'client': fastly_client,
+                'active_version': active_version,
+                'draft_version': draft_version,
+                'instrumentation_mapping': instrumentation_mapping,
+                'overhead': instrumentation_overhead,
+            }
 
-        fastly_client = FastlyApiClient(fastly_token, fastly_service_id)
+        with metrics_util.registry.phase('upload'):
+            services = concurrency_util.parallel_map(upload_service, list(enumerate(fastly_service_ids)),
+                                                     UPLOAD_WORKERS)
+        activated_services = []
 
-        active_version, draft_version, instrumentation_mapping = upload_instrumented_version(fastly_client,
-                                                                                             proxy_remote_addr)
+        def activate_service(service):
+            if stop_event.is_set():
+                return
+            cli_util.important('Activating version {} of service {}..'.format(service['draft_version'],
+                                                                              service['service_id']))
+            service['client'].activate_version(service['draft_version'])
+            activated_services.append(service)
 
-        logs_path = path.join('/tmp', 'syslog')
+        def reactivate_service(service):
+            service['client'].activate_version(service['active_version'])
+            cli_util.important('Reactivated original version {} of service {}'.format(service['active_version'],
+                                                                                       service['service_id']))
 
+        # a single aggregator for all the services, their logged names never collide
+        instrumentation_mappings = dict(((service['service_id'], name), vcl_mapping) for service in services
+                                        for name, vcl_mapping in service['instrumentation_mapping'].items())
+        aggregator = logs_processor.CoverageAggregator(count_hits=hit_counts,
+                                                       instrumentation_mapping=instrumentation_mappings)
+        collector = logs_collector.LogsCollector(aggregator, standalone_proxy, proxy_remote_addr, ngrok_auth_token,
+                                                 options['syslog_port'])
         try:
-            cli_util.important('Activating version {}..'.format(draft_version))
-            fastly_client.activate_version(draft_version)
+            # receiving before activating, so no log of the instrumented version is missed
+            collector.start()
+            with metrics_util.registry.phase('activate'):
+                concurrency_util.parallel_map(activate_service, services, UPLOAD_WORKERS)
 
-            fs_util.remove_file(path.join(logs_path, 'messages'))
+            # a daemon moves the coverage of every window out of the aggregator into this one
+            report_aggregator = logs_processor.CoverageAggregator(count_hits=hit_counts) if daemon_window_seconds \
+                else aggregator
 
-            logs_collector.start_listening(logs_path, standalone_proxy, proxy_remote_addr, listen_seconds,
-                                           ngrok_auth_token)
+            def on_window(results, window_start, window_end, sequence):
+                window_aggregator = logs_processor.CoverageAggregator(count_hits=hit_counts)
+                window_aggregator.merge_results(results)
+                write_window_snapshots(services, window_aggregator, multiple_services, window_start, window_end,
+                                       sequence, metadata, options['keep_windows'])
+                write_service_reports(services, report_aggregator, multiple_services, metadata)
 
-            instr_logs = logs_collector.collect_logs(logs_path)
-            processed_logs = logs_processor.process_logs(instr_logs)
+            def run_daemon(listening_aggregator):
+                deadline = time.time() + listen_seconds if listen_seconds else None
+                coverage_daemon.run_windows(listening_aggregator, daemon_window_seconds, on_window, stop_event,
+                                            deadline, report_aggregator)
 
-            coverage_object = reporter.calculate_coverage(instrumentation_mapping, processed_logs)
-            html_files, css = reporter.generate_html_report(coverage_object)
+            live_coverage = live_view.LiveCoverage(aggregator, dict(
+                ('{}/{}'.format(service_id, name) if multiple_services else name, vcl_mapping)
+                for (service_id, name), vcl_mapping in instrumentation_mappings.items()),
+                report_aggregator if report_aggregator is not aggregator else None)
+            live_coverage_server = live_view.LiveCoverageServer(live_coverage, port=options['live_port'])
+            summary_printer = live_view.SummaryPrinter(live_coverage, options['summary_seconds'])
+            try:
+                if options['live_port'] is not None:
+                    live_coverage_server.start()
+                    cli_util.important('Live coverage at {}'.format(
+                        cli_util.blue_bold('http://localhost:{}'.format(live_coverage_server.port))))
+                if options['summary_seconds']:
+                    summary_printer.start()
+                logs_collector.listen(aggregator, listen_seconds, options['stop_when_idle'],
+                                      run_daemon if daemon_window_seconds else None)
+            finally:
+                summary_printer.stop()
+                live_coverage_server.stop()
+                metrics_util.registry.increment('instr_lines_parsed', report_aggregator.message_count)
+                metrics_util.registry.increment('malformed_lines', report_aggregator.malformed_count)
 
-            reporter.write_html_report(html_files, css, coverage_object)
+            index_paths = write_service_reports(services, report_aggregator, multiple_services, metadata,
+                                                options['lcov_out'], options['cobertura_out'])
 
-            coverage_path = path.join(os.getcwd(), 'coverage')
-            cli_util.important('Coverage report saved to {}'.format(cli_util.blue_bold(coverage_path)))
-            cli_util.output('Opening coverage html report..')
-            fs_util.open_file(path.join(coverage_path, 'index.html'))
+            if not multiple_services and not daemon_window_seconds:
+                cli_util.output('Opening coverage html report..')
+                fs_util.open_file(index_paths[0])
 
         finally:
-            fs_util.remove_file(path.join(logs_path, 'messages'))
-            fastly_client.activate_version(active_version)
-            cli_util.important('Reactivated original version {}'.format(active_version))
+            with metrics_util.registry.phase('reactivate'):
+                concurrency_util.parallel_map(reactivate_service, activated_services, UPLOAD_WORKERS)
+            collector.stop()
+        succeeded = True
 
     except Exception as err:
         cli_util.exception_format(err)
+    finally:
+        coverage_daemon.restore_signals(previous_signal_handlers)
+
+    metrics_util.write_metrics(options['metrics_out'], options['metrics_textfile'])
+    return succeeded
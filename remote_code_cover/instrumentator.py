@@ -1,60 +1,201 @@
+import json
 import re
-
-from .constants import SYSLOG_INSTRUMENTATION_NAME
+from os import path
+from .constants import SYSLOG_INSTRUMENTATION_NAME, LOG_ENCODING_LINES, LOG_ENCODING_BITMASK, BITMASK_GROUP_SIZE, \
+    SAMPLING_HEADER, SAMPLING_DENOMINATOR, INSTRUMENTATION_CACHE_VERSION, LOG_MODE_SUBROUTINE, LOG_MODE_REQUEST, \
+    REQUEST_COVERAGE_HEADER, REQUEST_PAYLOAD_SEPARATOR, REQUEST_LOG_SUBROUTINES, FETCH_LOG_SUBROUTINE, \
+    REQUEST_START_SUBROUTINE, BACKEND_REQUEST_SUBROUTINES, FETCH_SUBROUTINES, FETCH_COVERAGE_HEADER
+from .utils import cache_util, fs_util, string_util
+from .vcl_parser import VclScanner, TOKEN_SYMBOL, TOKEN_WORD, get_subroutine_names, iter_subroutines
+
+RETURN_KEYWORDS = ('return', 'error', 'restart')
+# keywords continuing an if statement, nothing can be inserted before them
+ELSE_KEYWORDS = ('else', 'elsif', 'elseif')
+MAPPING_FILE_VERSION = 1
+# `# rcc: ignore` on a `sub` line excludes the subroutine, on any other line that line,
+# and `# rcc: ignore-start` .. `# rcc: ignore-end` exclude the lines in between
+PRAGMA_PATTERN = re.compile(r'(?:#|//)\s*rcc:\s*(ignore-start|ignore-end|ignore)\b')
+PRAGMA_IGNORE = 'ignore'
+PRAGMA_IGNORE_START = 'ignore-start'
+PRAGMA_IGNORE_END = 'ignore-end'
+MAPPING_FILE_NAME = 'instrumentation_mapping.json'
+
+
+def get_declaration_line(line_number, position, log_encoding=LOG_ENCODING_LINES):
+    """
+    :return string: the declaration of the local holding the coverage of a tested line,
+    or None when the local was already declared for a previous line
+    """
+    if log_encoding == LOG_ENCODING_BITMASK:
+        # every group of lines shares an INTEGER local that holds one bit per line
+        group, bit = divmod(position, BITMASK_GROUP_SIZE)
+        return '  declare local var.log_g{} INTEGER;'.format(group) if bit == 0 else None
+    return '  declare local var.log_{} BOOL;'.format(line_number)
 
 
-def get_var_line(line_number, tested_line_numbers, sub_tested_line_numbers,
-                 instr_lines, sub_start_line_number, l_ws_cou):
-    sub_tested_line_numbers.append(line_number)
-    tested_line_numbers.append(line_number)
-    instr_lines.insert(sub_start_line_number, '  declare local var.log_{} BOOL;'.format(line_number))
+def get_var_line(line_number, position, l_ws_cou, log_encoding=LOG_ENCODING_LINES):
+    if log_encoding == LOG_ENCODING_BITMASK:
+        group, bit = divmod(position, BITMASK_GROUP_SIZE)
+        return '{}set var.log_g{} |= {};'.format(' ' * l_ws_cou, group, 1 << bit)
     return '{}set var.log_{} = true;'.format(' ' * l_ws_cou, line_number)
 
 
-def get_syslog_line(name, sub_tested_line_numbers, l_ws_cou):
+def get_sampling_lines(sample_rate):
+    """
+    :param float sample_rate: the fraction of requests to log
+    :return list(string): the lines that draw the sampling decision of the request once
+    """
+    numerator = int(round(sample_rate * SAMPLING_DENOMINATOR))
+    return [
+        '  if (!req.http.{}) {{'.format(SAMPLING_HEADER),
+        '    set req.http.{} = if(randombool({}, {}), "1", "0");'.format(SAMPLING_HEADER, numerator,
+                                                                     SAMPLING_DENOMINATOR),
+        '  }',
+    ]
+
+
+def get_header_reset_lines(sub_name, headers):
+    """
+    The rcc request headers must not be trusted from the client, who could otherwise force the sampling decision
+    or forge coverage, nor be sent to the origin
+    :param string sub_name:
+    :param list(string) headers: the request headers the instrumentation uses
+    :return list(string): the lines dropping the headers at the start of the request and of the backend requests
+    """
+    if not headers:
+        return []
+    if sub_name == REQUEST_START_SUBROUTINE:
+        return ['  if (req.restarts == 0) {'] + ['    unset req.http.{};'.format(header) for header in headers] + \
+            ['  }']
+    if sub_name in BACKEND_REQUEST_SUBROUTINES:
+        return ['  unset bereq.http.{};'.format(header) for header in headers]
+    return []
+
+
+def get_payload_parts(name, sub_tested_line_numbers, log_encoding=LOG_ENCODING_LINES, sub_index=0):
+    """
+    :return string, string: the constant prefix of the payload of a subroutine and the VCL expression appending
+    its covered lines
+    """
+    if log_encoding == LOG_ENCODING_BITMASK:
+        # one hex digit per group, the n-th digit holds the bits of the n-th group of the subroutine tested lines
+        group_count = (len(sub_tested_line_numbers) + BITMASK_GROUP_SIZE - 1) // BITMASK_GROUP_SIZE
+        log_additions = ''.join([' + std.itoa(var.log_g{}, 16)'.format(group) for group in range(group_count)])
+        return '{}:{}:'.format(name, sub_index), log_additions
     log_additions = ''.join([' + if(var.log_{}, "{} ", "")'.format(l_n, l_n) for l_n in sub_tested_line_numbers])
-    log_template = '{}log "syslog " req.service_id " {} :: [INSTR] {},"{};'
-    return log_template.format(' ' * l_ws_cou, SYSLOG_INSTRUMENTATION_NAME, name, log_additions)
+    return '{},'.format(name), log_additions
 
 
-def is_line_sub_header(line):
-    return line[:4] == 'sub '
+def get_sampled_statement(statement, sample_rate=None):
+    """
+    :return string: the statement, run only by the sampled requests when sampling
+    """
+    if sample_rate is None:
+        return statement
+    return 'if (req.http.{} == "1") {{ {} }}'.format(SAMPLING_HEADER, statement)
 
 
-def count_leading_whitespaces(line):
-    return len(line) - len(line.lstrip())
+def get_syslog_line(name, sub_tested_line_numbers, l_ws_cou, log_encoding=LOG_ENCODING_LINES, sub_index=0,
+                    sample_rate=None):
+    log_template = '{}log "syslog " req.service_id " {} :: [INSTR] {}"{};'
+    payload_prefix, log_additions = get_payload_parts(name, sub_tested_line_numbers, log_encoding, sub_index)
+    log_line = log_template.format('', SYSLOG_INSTRUMENTATION_NAME, payload_prefix, log_additions)
+    return ' ' * l_ws_cou + get_sampled_statement(log_line, sample_rate)
 
 
-def do_test_line(line):
-    return line != '' and line[0] != '#'
+def get_append_statement(header, value):
+    """
+    :return string: the statement appending a VCL expression to the payloads a request header holds
+    """
+    return 'set req.http.{0} = if(req.http.{0}, req.http.{0} + "{1}", "") + {2};'.format(
+        header, REQUEST_PAYLOAD_SEPARATOR, value)
 
 
-def strip_line(line):
-    # find trailing comment and remove it
-    matches = re.findall(r'{\s*(#.*)', line)
-    if len(matches) > 0:
-        line = line.replace(matches[0], '')
-    stripped_line = line.strip()
-    return stripped_line
+def get_request_syslog_line(name, sub_tested_line_numbers, l_ws_cou, log_encoding=LOG_ENCODING_LINES, sub_index=0,
+                            sample_rate=None, flush=False, fetch=False):
+    """
+    The request log mode counterpart of `get_syslog_line`, appends the payload of the subroutine to the
+    coverage of the request, and when `flush` is set logs the coverage of the request and clears it.
+    The subroutines of the fetch accumulate their coverage apart, logged by the fetch node at the end of vcl_fetch,
+    whatever is left of it, e.g. when the fetch failed, is logged with the coverage of the request
+    :param bool fetch: whether the subroutine runs on the fetch node
+    :return string:
+    """
+    payload_prefix, log_additions = get_payload_parts(name, sub_tested_line_numbers, log_encoding, sub_index)
+    header = FETCH_COVERAGE_HEADER if fetch else REQUEST_COVERAGE_HEADER
+    log_line = get_sampled_statement(get_append_statement(header, '"{}"{}'.format(payload_prefix, log_additions)),
+                                     sample_rate)
+    if flush and not fetch:
+        log_line += ' if (req.http.{0}) {{ {1} unset req.http.{0}; }}'.format(
+            FETCH_COVERAGE_HEADER, get_append_statement(REQUEST_COVERAGE_HEADER, 'req.http.' + FETCH_COVERAGE_HEADER))
+    if flush:
+        log_line += ' if (req.http.{0}) {{ log "syslog " req.service_id " {1} :: [INSTR] " req.http.{0}; ' \
+                    'unset req.http.{0}; }}'.format(header, SYSLOG_INSTRUMENTATION_NAME)
+    return ' ' * l_ws_cou + log_line
+
+
+def get_request_log_subroutines(vcls):
+    """
+    The subroutines logging the coverage of the request in the request log mode: the one ending the request
+    and the one ending the fetch
+    :param list(dict) vcls: the custom vcls
+    :return list(string):
+    """
+    defined_names = set(name for vcl in vcls for name in get_subroutine_names(vcl['content']))
+    final_subroutines = [name for name in REQUEST_LOG_SUBROUTINES if name in defined_names]
+    if not final_subroutines:
+        raise Exception('The request log mode needs the vcls to define one of {}'.format(
+            ', '.join(REQUEST_LOG_SUBROUTINES)))
+    return [final_subroutines[0], FETCH_LOG_SUBROUTINE]
 
 
-def has_open_params(is_tested, line):
-    return is_tested and line[-1] == '{'
+def get_pragma(comment):
+    """
+    :param string comment: the line comment of a line, see `VclScanner.comment`, or None
+    :return string: the rcc pragma of the comment, or None
+    """
+    match = PRAGMA_PATTERN.match(comment) if comment and 'rcc' in comment else None
+    return match.group(1) if match else None
 
 
-def has_close_params(is_tested, line):
-    return is_tested and line[0] == '}'
+def count_leading_whitespaces(line):
+    return len(line) - len(line.lstrip())
 
 
-def is_return_line(line):
-    return line[:6] == 'return' or line[:6] == 'error ' or line[:7] == 'restart'
+def is_tested_line(starts_in_literal, tokens):
+    """
+    A line is tested when it starts a statement. Lines continuing a multi-line statement, long string
+    or comment are not, and neither are lines closing a block unless they open a new one (`} else {`)
+    """
+    if starts_in_literal or not tokens or not tokens[0].statement_start:
+        return False
+    if tokens[0].text == '}':
+        return tokens[-1].text == '{'
+    return tokens[0].kind == TOKEN_WORD and tokens[0].text not in ELSE_KEYWORDS
+
+
+def insert_statements(line, insertions):
+    """
+    :param string line:
+    :param list((integer, string)) insertions: column and statement pairs
+    :return string: the line with every statement inserted before its column
+    """
+    for column, statement in sorted(insertions, reverse=True):
+        line = '{}{} {}'.format(line[:column], statement, line[column:])
+    return line
 
 
-def end_of_subroutine(in_subroutine, parens_stack):
-    return in_subroutine and len(parens_stack) == 0
+def flatten_lines(instrumented_lines):
+    for item in instrumented_lines:
+        if isinstance(item, list):
+            for line in item:
+                yield line
+        else:
+            yield item
 
 
-def add_instrumentation(name, content):
+def add_instrumentation(name, content, log_encoding=LOG_ENCODING_LINES, sample_rate=None,
+                        request_log_subroutines=None, instrumented_subroutines=None):
     """
     Adds instrumentation to the code.
 
@@ -62,97 +203,294 @@ def add_instrumentation(name, content):
     1. Coverage is only done inside subroutines
     2. Blank lines are omitted
     3. Comments are omitted
+    4. Lines continuing a multi-line statement, long string or comment are omitted
+    5. Subroutines and lines excluded by an `rcc: ignore` pragma comment are omitted
+
+    The request headers the instrumentation uses are dropped at the start of vcl_recv and of the backend requests,
+    whether these subroutines are instrumented or not
 
     :param string name: the name of the file
     :param string content: the code to instrument
-    :return string, integer, list: instrumented code, original file line count
-    and a list of line numbers that are tested for coverage
+    :param string log_encoding: how covered lines are encoded in the logs, a list of line numbers
+    or a bitmask of the subroutine tested lines
+    :param float sample_rate: optional - the fraction of requests to log, requests out of the sample are not logged
+    :param list(string) request_log_subroutines: optional - logs once per request instead of at every subroutine
+    exit, the coverage is accumulated in a request header and logged at the exits of these subroutines
+    :param list(string) instrumented_subroutines: optional - the names of the subroutines to instrument,
+    all of them when not set
+    :return string, integer, list, list: instrumented code, original file line count,
+    a list of line numbers that are tested for coverage and the subroutines with their tested line numbers
     """
-    lines = content.split('\n')
-    original_line_count = 1
+    scanner = VclScanner()
     instrumented_lines = []
-    subroutine_parenthesis_stack = []
-    sub_tested_line_numbers = []
     tested_line_numbers = []
-    cur_subroutine_decl_line_number = 0
+    subroutines = []
+    sub_tested_line_numbers = []
+    sub_declarations = []
+    depth = 0
+    expecting_sub_name = False
+    pending_sub_name = None
+    pending_sub_line_number = None
+    pending_sub_ignored = False
     in_subroutine = False
-    in_synthetic = False
-
-    for raw_line in lines:
-        stripped_line = strip_line(raw_line)
-        is_tested = do_test_line(stripped_line)
+    in_ignored_block = False
+    original_line_count = 1
+    reset_headers = ([SAMPLING_HEADER] if sample_rate is not None else []) + \
+        ([REQUEST_COVERAGE_HEADER, FETCH_COVERAGE_HEADER] if request_log_subroutines is not None else [])
+
+    def get_sub_syslog_line(l_ws_cou):
+        subroutines[-1]['exit_count'] += 1
+        if request_log_subroutines is not None:
+            return get_request_syslog_line(name, sub_tested_line_numbers, l_ws_cou, log_encoding,
+                                           len(subroutines) - 1, sample_rate,
+                                           subroutines[-1]['name'] in request_log_subroutines,
+                                           subroutines[-1]['name'] in FETCH_SUBROUTINES)
+        return get_syslog_line(name, sub_tested_line_numbers, l_ws_cou, log_encoding, len(subroutines) - 1,
+                               sample_rate)
+
+    for raw_line in content.split('\n'):
+        starts_in_literal, tokens = scanner.scan(raw_line)
         l_ws_cou = count_leading_whitespaces(raw_line)
-
-        def add_log_line(subroutine_decl_line_number=cur_subroutine_decl_line_number, my_l_ws_cou=l_ws_cou):
-            instrumented_lines.append(get_var_line(original_line_count, tested_line_numbers, sub_tested_line_numbers,
-                                                   instrumented_lines, subroutine_decl_line_number, my_l_ws_cou))
-
-        if is_line_sub_header(stripped_line):
-            # if we reached a sub header, we add the log for it *after*
-            # the line since we can't log outside subroutines
-            in_subroutine = True
-            instrumented_lines.append(raw_line)
-            cur_subroutine_decl_line_number = len(instrumented_lines)
-            subroutine_parenthesis_stack.append(original_line_count)
-        elif not in_subroutine:
-            instrumented_lines.append(raw_line)
-        elif in_subroutine:
-            if stripped_line[:11] == 'synthetic {':
-                add_log_line(subroutine_decl_line_number=cur_subroutine_decl_line_number,
-                             my_l_ws_cou=2)
-                in_synthetic = True
-                if stripped_line[-2:] == '};':
-                    in_synthetic = False
-            elif in_synthetic:
-                if stripped_line[-2:] == '};':
-                    in_synthetic = False
-            elif has_close_params(is_tested, stripped_line):  # is_close_parens
-                subroutine_parenthesis_stack.pop()
-                if end_of_subroutine(in_subroutine, subroutine_parenthesis_stack):
-                    instrumented_lines.append(get_syslog_line(name, sub_tested_line_numbers, 2))
-                    sub_tested_line_numbers = []
+        was_in_subroutine = in_subroutine
+        pragma = get_pragma(scanner.comment)
+        in_ignored_block = (in_ignored_block or pragma == PRAGMA_IGNORE_START) and pragma != PRAGMA_IGNORE_END
+        is_tested = in_subroutine and not in_ignored_block and pragma not in (PRAGMA_IGNORE, PRAGMA_IGNORE_END) \
+            and is_tested_line(starts_in_literal, tokens)
+        if is_tested:
+            position = len(sub_tested_line_numbers)
+            sub_tested_line_numbers.append(original_line_count)
+            tested_line_numbers.append(original_line_count)
+            declaration_line = get_declaration_line(original_line_count, position, log_encoding)
+            if declaration_line:
+                sub_declarations.append(declaration_line)
+            var_line = get_var_line(original_line_count, position, l_ws_cou, log_encoding)
+            # a line opening a new branch (`} else {`) is covered when the branch is taken, mark it inside
+            opens_branch = tokens[0].text == '}'
+            if not opens_branch:
+                instrumented_lines.append(var_line)
+
+        # log before every exit of the subroutine, a return or the closing brace
+        insertions = []
+        sub_started = False
+        opened_sub_name = None
+        for token in tokens:
+            if token.kind == TOKEN_SYMBOL and token.text == '{':
+                if depth == 0 and pending_sub_name is not None:
+                    opened_sub_name = pending_sub_name
+                    if not (pending_sub_ignored or pragma == PRAGMA_IGNORE) and \
+                            (instrumented_subroutines is None or pending_sub_name in instrumented_subroutines):
+                        in_subroutine = sub_started = True
+                        subroutines.append({
+                            'name': pending_sub_name,
+                            'line_number': pending_sub_line_number,
+                            'tested_line_numbers': sub_tested_line_numbers,
+                            # the number of log statements, one before every exit
+                            'exit_count': 0,
+                        })
+                    pending_sub_name = None
+                depth += 1
+            elif token.kind == TOKEN_SYMBOL and token.text == '}':
+                depth = max(depth - 1, 0)
+                if depth == 0 and in_subroutine:
                     in_subroutine = False
-                elif has_open_params(is_tested, stripped_line):
-                    add_log_line()
-                    subroutine_parenthesis_stack.append(original_line_count)
-            elif has_open_params(is_tested, stripped_line):  # is_open_parens
-                add_log_line()
-                subroutine_parenthesis_stack.append(original_line_count)
-            elif is_return_line(stripped_line):
-                add_log_line()
-                instrumented_lines.append(get_syslog_line(name, sub_tested_line_numbers, l_ws_cou))
-            elif is_tested:
-                add_log_line()
-
-            instrumented_lines.append(raw_line)
+                    if was_in_subroutine:
+                        insertions.append((token.column, 2))
+            elif token.kind == TOKEN_WORD:
+                if depth == 0 and expecting_sub_name:
+                    pending_sub_name = token.text
+                    pending_sub_line_number = original_line_count
+                    pending_sub_ignored = pragma == PRAGMA_IGNORE
+                    expecting_sub_name = False
+                elif depth == 0 and token.statement_start and token.text == 'sub':
+                    expecting_sub_name = True
+                elif in_subroutine and was_in_subroutine and token.statement_start and token.text in RETURN_KEYWORDS:
+                    insertions.append((token.column, l_ws_cou))
+
+        first_column = tokens[0].column if tokens and not starts_in_literal else None
+        inline_insertions = []
+        for column, exit_l_ws_cou in insertions:
+            if column == first_column:
+                instrumented_lines.append(get_sub_syslog_line(exit_l_ws_cou))
+            else:
+                inline_insertions.append((column, get_sub_syslog_line(0)))
+        instrumented_lines.append(insert_statements(raw_line, inline_insertions))
+        if is_tested and opens_branch:
+            instrumented_lines.append('  ' + var_line)
+
+        if sub_started:
+            # the declarations are only known at the end of the subroutine, keep their place
+            sub_declarations = []
+            instrumented_lines.append(sub_declarations)
+        if opened_sub_name is not None:
+            instrumented_lines.extend(get_header_reset_lines(opened_sub_name, reset_headers))
+        if sub_started and sample_rate is not None:
+            instrumented_lines.extend(get_sampling_lines(sample_rate))
+        if was_in_subroutine and not in_subroutine:
+            sub_tested_line_numbers = []
 
         original_line_count += 1
 
-    instrumented_content = '\n'.join(instrumented_lines)
-    return instrumented_content, original_line_count, tested_line_numbers
+    instrumented_content = '\n'.join(flatten_lines(instrumented_lines))
+    return instrumented_content, original_line_count, tested_line_numbers, subroutines
+
+
+def add_cached_instrumentation(name, content, log_encoding=LOG_ENCODING_LINES, sample_rate=None, cache_dir=None,
+                               request_log_subroutines=None, instrumented_subroutines=None):
+    """
+    `add_instrumentation` with its results cached on disk, keyed by a hash of the content and the options
+    :param string cache_dir: optional - the cache directory, no caching when not set
+    :return string, integer, list, list: see `add_instrumentation`
+    """
+    if not cache_dir:
+        return add_instrumentation(name, content, log_encoding, sample_rate, request_log_subroutines,
+                                   instrumented_subroutines)
+
+    key = cache_util.content_hash(INSTRUMENTATION_CACHE_VERSION, name, content, log_encoding, sample_rate,
+                                  request_log_subroutines, instrumented_subroutines)
+    cached = cache_util.load(cache_dir, key)
+    if cached is None:
+        cached = dict(zip(['content', 'orig_line_count', 'tested_line_numbers', 'subroutines'],
+                          add_instrumentation(name, content, log_encoding, sample_rate, request_log_subroutines,
+                                              instrumented_subroutines)))
+        cache_util.store(cache_dir, key, cached)
+    return cached['content'], cached['orig_line_count'], cached['tested_line_numbers'], cached['subroutines']
+
+
+def read_vcl_files(paths):
+    """
+    Reads local custom vcls, every `.vcl` file is a custom vcl named after the file
+    :param list(string) paths: VCL files and directories
+    :return list(dict): custom vcls as returned by the Fastly API
+    """
+    filenames = [filename for filename in fs_util.list_files(paths) if filename.endswith('.vcl')]
+    if not filenames:
+        raise Exception('No .vcl files found in {}'.format(', '.join(paths)))
+    return [{'name': path.splitext(path.basename(filename))[0], 'content': fs_util.read_file(filename)}
+            for filename in filenames]
+
+
+def is_included(name, include_patterns=None, exclude_patterns=None):
+    """
+    :param string name:
+    :param list(string) include_patterns: optional - globs or `re:` prefixed regular expressions,
+    when set the name has to match one of them
+    :param list(string) exclude_patterns: optional - the name must not match any of them
+    :return bool:
+    """
+    return (not include_patterns or string_util.matches_any(name, include_patterns)) and \
+        not (exclude_patterns and string_util.matches_any(name, exclude_patterns))
+
+
+def filter_subroutines(vcls, filters=None, instrumented_subroutines=None):
+    """
+    Applies name filters to the vcls and subroutines to instrument
+    :param list(dict) vcls: the custom vcls
+    :param dict filters: optional - name patterns, see `is_included`, by `include_vcls`, `exclude_vcls`,
+    `include_subroutines` and `exclude_subroutines`
+    :param dict instrumented_subroutines: optional - key: vcl name, value: the subroutines to filter,
+    all the subroutines of the vcls when not set
+    :return dict: key: vcl name, value: the names of its subroutines to instrument,
+    `instrumented_subroutines` unchanged when there is no filter
+    """
+    filters = filters or {}
+    if not any(filters.values()):
+        return instrumented_subroutines
 
+    filtered_subroutines = {}
+    for vcl in vcls:
+        name = vcl['name']
+        if not is_included(name, filters.get('include_vcls'), filters.get('exclude_vcls')):
+            filtered_subroutines[name] = []
+            continue
+        sub_names = instrumented_subroutines.get(name, []) if instrumented_subroutines is not None \
+            else get_subroutine_names(vcl['content'])
+        filtered_subroutines[name] = [sub_name for sub_name in sub_names if is_included(
+            sub_name, filters.get('include_subroutines'), filters.get('exclude_subroutines'))]
+    return filtered_subroutines
 
-def instrument(vcls):
+
+def get_changed_subroutines(vcls, baseline_vcls):
+    """
+    Compares the subroutines of the custom vcls to a baseline, a subroutine changed when its code differs from
+    the subroutine of the same name in the custom vcl of the same name, or when the baseline has no such subroutine
+    :param list(dict) vcls: the custom vcls
+    :param list(dict) baseline_vcls: the custom vcls to compare to
+    :return dict: key: vcl name, value: the names of its changed subroutines
+    """
+    baseline_subroutines = dict((vcl['name'], dict(iter_subroutines(vcl['content']))) for vcl in baseline_vcls)
+    changed_subroutines = {}
+    for vcl in vcls:
+        vcl_baseline_subroutines = baseline_subroutines.get(vcl['name'], {})
+        changed_subroutines[vcl['name']] = [name for name, code in iter_subroutines(vcl['content'])
+                                            if vcl_baseline_subroutines.get(name) != code]
+    return changed_subroutines
+
+
+def write_mapping(instrumentation_mapping, filename):
+    """
+    Saves an instrumentation mapping, to build coverage out of the logs of the instrumented code later on
+    :param dict instrumentation_mapping:
+    :param string filename:
+    :return None:
+    """
+    fs_util.write_file(filename, json.dumps({'version': MAPPING_FILE_VERSION, 'mapping': instrumentation_mapping}))
+
+
+def read_mapping(filename):
+    """
+    :param string filename: a file written by `write_mapping`
+    :return dict: the instrumentation mapping
+    """
+    saved = json.loads(fs_util.read_file(filename))
+    if saved.get('version') != MAPPING_FILE_VERSION:
+        raise Exception('The instrumentation mapping {} was written by another version of rcc'.format(filename))
+    return saved['mapping']
+
+
+def instrument(vcls, log_encoding=LOG_ENCODING_LINES, sample_rate=None, cache_dir=None, name_prefix='',
+               log_mode=LOG_MODE_SUBROUTINE, instrumented_subroutines=None):
     """
     Given a list of custom_vcls, add instrumentation to them and return the instrumentation mapping
     :param vcls: array of dictionaries {"name", "content"}
+    :param string log_encoding: how covered lines are encoded in the logs
+    :param float sample_rate: optional - the fraction of requests to log
+    :param string cache_dir: optional - a directory to cache the instrumentation results in
+    :param string name_prefix: optional - prefixes the logged names, telling apart the logs of many services
+    :param string log_mode: whether to log at every subroutine exit or once per request
+    :param dict instrumented_subroutines: optional - key: vcl name, value: the names of its subroutines to
+    instrument, e.g. the changed ones. The vcls with no subroutine to instrument are left out of the mapping.
+    In the request log mode, the subroutines logging the request are always instrumented
     :return list, dictionary: A tuple of the instrumented custom_vcls and their mapping
     """
+    if sample_rate is not None and not 0 < sample_rate <= 1:
+        raise Exception('Sample rate should be between 0 and 1, got {}'.format(sample_rate))
+    request_log_subroutines = get_request_log_subroutines(vcls) if log_mode == LOG_MODE_REQUEST else None
+
     instr_mapping = {}
     instr_vcls = []
     for i, vcl in enumerate(vcls):
         name = vcl['name']
         content = vcl['content']
-        instr_content, orig_line_count, tested_line_numbers = add_instrumentation(str(i), content)
+        name_mapping = name_prefix + str(i) if name_prefix else i
+        vcl_instrumented_subroutines = None
+        if instrumented_subroutines is not None:
+            vcl_instrumented_subroutines = sorted(set(instrumented_subroutines.get(name, [])) |
+                                                  set(request_log_subroutines or []))
+        instr_content, orig_line_count, tested_line_numbers, subroutines = add_cached_instrumentation(
+            str(name_mapping), content, log_encoding, sample_rate, cache_dir, request_log_subroutines,
+            vcl_instrumented_subroutines)
         instr_vcl = dict(vcl)
         instr_vcl['content'] = instr_content
         instr_vcls.append(instr_vcl)
+        if instrumented_subroutines is not None and not subroutines:
+            continue
         instr_mapping[name] = {
             'original_content': content,
             'orig_line_count': orig_line_count,
             'tested_line_count': len(tested_line_numbers),
             'tested_line_numbers': tested_line_numbers,
-            'name_mapping': i
+            'subroutines': subroutines,
+            'name_mapping': name_mapping
         }
 
     return instr_vcls, instr_mapping
@@ -0,0 +1,186 @@
+import json
+import sys
+import threading
+from os import path
+from .reporter import calc_percentage
+from .utils import bitset_util, cli_util, fs_util
+
+if sys.version_info[0] < 3:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+else:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+CUR_DIR = path.dirname(__file__)
+EVENTS_INTERVAL_SECONDS = 1
+
+
+class LiveCoverage:
+    """
+    Computes the current coverage percentages out of an aggregator that is still receiving logs.
+    Only the covered lines counts are calculated, so a summary is cheap enough to take every second
+    """
+
+    def __init__(self, aggregator, instrumentation_mapping, cumulative_aggregator=None):
+        """
+        :param logs_processor.CoverageAggregator aggregator:
+        :param dict instrumentation_mapping: key: the name to show, value: the instrumentation mapping of the file
+        :param logs_processor.CoverageAggregator cumulative_aggregator: optional - the coverage taken out of
+        `aggregator` so far, e.g. the past windows of a daemon, summarized along with it
+        """
+        self.aggregator = aggregator
+        self.cumulative_aggregator = cumulative_aggregator
+        self.tested_lines = dict((name, (str(vcl_mapping['name_mapping']),
+                                         bitset_util.from_line_numbers(vcl_mapping['tested_line_numbers']),
+                                         vcl_mapping['tested_line_count']))
+                                 for name, vcl_mapping in instrumentation_mapping.items())
+
+    def summary(self):
+        """
+        :return dict: the global and per file coverage percentages and the number of received logs
+        """
+        with self.aggregator.lock:
+            covered_lines = dict(self.aggregator.covered_lines)
+            message_count = self.aggregator.message_count
+            # locked in the order `CoverageAggregator.pop_results` locks them, so no window is missed
+            if self.cumulative_aggregator is not None:
+                with self.cumulative_aggregator.lock:
+                    for name, lines_bitset in self.cumulative_aggregator.covered_lines.items():
+                        covered_lines[name] = covered_lines.get(name, 0) | lines_bitset
+                    message_count += self.cumulative_aggregator.message_count
+
+        files = {}
+        global_covered_line_count = 0
+        global_tested_line_count = 0
+        for name, (name_mapping, tested, tested_line_count) in self.tested_lines.items():
+            covered_line_count = bitset_util.count(covered_lines.get(name_mapping, 0) & tested)
+            files[name] = {
+                'coverage_line_percentage': calc_percentage(covered_line_count, tested_line_count),
+                'covered_line_count': covered_line_count,
+                'tested_line_count': tested_line_count,
+            }
+            global_covered_line_count += covered_line_count
+            global_tested_line_count += tested_line_count
+
+        return {
+            'message_count': message_count,
+            'files': files,
+            'global': {
+                'coverage_line_percentage': calc_percentage(global_covered_line_count, global_tested_line_count),
+                'covered_line_count': global_covered_line_count,
+                'tested_line_count': global_tested_line_count,
+            },
+        }
+
+
+class LiveCoverageHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/':
+            self.send_body('text/html; charset=utf-8', fs_util.read_file(path.join(CUR_DIR, 'assets', 'live.html')))
+        elif self.path == '/coverage':
+            self.send_body('application/json', json.dumps(self.server.live_coverage.summary()))
+        elif self.path == '/events':
+            self.send_events()
+        else:
+            self.send_error(404)
+
+    def send_events(self):
+        """
+        Pushes the coverage summary as server-sent events whenever new logs arrived, until the server stops
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        last_message_count = None
+        try:
+            while True:
+                summary = self.server.live_coverage.summary()
+                if summary['message_count'] != last_message_count:
+                    last_message_count = summary['message_count']
+                    self.wfile.write('data: {}\n\n'.format(json.dumps(summary)).encode('utf-8'))
+                    self.wfile.flush()
+                if self.server.stop_event.wait(EVENTS_INTERVAL_SECONDS):
+                    return
+        except (IOError, OSError):
+            # the browser went away
+            pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class LiveCoverageServer:
+    """
+    A local HTTP server showing the coverage while the logs are being received.
+    `/` is a page following the coverage, `/coverage` the current summary as json,
+    and `/events` pushes the summary as server-sent events
+    """
+
+    def __init__(self, live_coverage, host='127.0.0.1', port=0):
+        self.live_coverage = live_coverage
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), LiveCoverageHandler)
+        self.server.live_coverage = self.live_coverage
+        self.server.stop_event = threading.Event()
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='live-coverage')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server:
+            self.server.stop_event.set()
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+
+class SummaryPrinter:
+    """
+    Periodically prints the global coverage to the terminal while the logs are being received
+    """
+
+    def __init__(self, live_coverage, interval_seconds):
+        self.live_coverage = live_coverage
+        self.interval_seconds = interval_seconds
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def print_summaries(self):
+        while not self.stop_event.wait(self.interval_seconds):
+            summary = self.live_coverage.summary()
+            cli_util.output('Coverage {}% ({}/{} lines) from {} instrumentation logs'.format(
+                summary['global']['coverage_line_percentage'], summary['global']['covered_line_count'],
+                summary['global']['tested_line_count'], summary['message_count']))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.print_summaries, name='coverage-summary')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
@@ -1,10 +1,22 @@
 import docker
+import os
+import threading
 import time
 import sys
-from os import path
-from .utils import fs_util, cli_util
+from .syslog_receiver import SyslogReceiver, DEFAULT_PORT
+from .utils import cli_util, metrics_util
 
-CUR_DIR = path.dirname(__file__)
+# the longest wait for the ngrok container to open its tunnel
+NGROK_BOOT_TIMEOUT_SECONDS = 30
+NGROK_TUNNEL_STARTED_LOG = b'started tunnel'
+# after the tests finished, logs still in flight are waited for until none arrived for this long
+DRAIN_IDLE_SECONDS = 1
+DRAIN_MAX_SECONDS = 5
+POLL_INTERVAL_SECONDS = 0.2
+DEFAULT_SYSLOG_PORT = DEFAULT_PORT
+# how the ngrok container reaches the syslog server of the host, resolved by Docker Desktop and mapped to the
+# host gateway elsewhere
+DOCKER_HOST_ADDRESS = 'host.docker.internal'
 
 if sys.version_info[0] < 3:
     user_input = raw_input
@@ -12,80 +24,177 @@ else:
     user_input = input
 
 
-def run_syslog_server(logs_path, syslog_config_path):
+def run_syslog_server(handle_message, syslog_port=DEFAULT_SYSLOG_PORT):
     """
-    Runs a syslog server that creates a volume with host in `log_path` and dumps logs there
-    :param string logs_path: the host path where the logs will be saved for later processing
-    :param string syslog_config_path: the syslog config path
-    :return: The handle to the container to control it upstream
+    Runs an in-process syslog server that passes every received message to `handle_message`
+    :param function handle_message: called with each syslog message (string) as it arrives
+    :param integer syslog_port: the local TCP/UDP port to listen on
+    :return: The handle to the receiver to control it upstream
     """
-    client = docker.from_env()
-    volumes = [
-        '{}:/var/log'.format(logs_path),
-        '{}:/etc/syslog-ng/syslog-ng.conf'.format(syslog_config_path)
-    ]
-    container_handle = client.containers.run(image='balabit/syslog-ng:latest', command='--no-caps', stdout=True,
-                                             stderr=True, remove=True, detach=True, volumes=volumes,
-                                             ports={'514': '514'}, name='instrumentation-syslog-ng')
-    return container_handle
+    receiver = SyslogReceiver(handle_message, port=syslog_port)
+    receiver.start()
+    return receiver
 
 
-def run_ngrok(auth_token, remote_addr):
+def run_ngrok(auth_token, remote_addr, syslog_port=DEFAULT_SYSLOG_PORT):
     """
     Runs an ngrok docker container that the fastly service will send logs to
     :param string auth_token: the ngrok user authentication token
     :param  string remote_addr: the ngrok remote address to expose
+    :param integer syslog_port: the local port of the syslog server
     :return: The handle to the container to control it upstream
     """
     client = docker.from_env()
-    syslog_name = 'instrumentation-syslog-ng'
 
     auth_token_str = '--authtoken ' + auth_token if auth_token else ''
-    command = 'ngrok tcp {} --remote-addr {} {}:514'.format(auth_token_str, remote_addr, syslog_name)
-    links = {syslog_name: syslog_name}
+    command = 'ngrok tcp {} --log stdout --remote-addr {} {}:{}'.format(auth_token_str, remote_addr,
+                                                                         DOCKER_HOST_ADDRESS, syslog_port)
+    # the syslog server runs in this process on the host, the name is unique to this process so concurrent runs
+    # do not collide
     container_handle = client.containers.run(image='wernight/ngrok:latest', command=command, stdout=True,
-                                             stderr=True, remove=True, detach=True, links=links,
-                                             name='instrumentation-ngrok')
+                                             stderr=True, remove=True, detach=True,
+                                             extra_hosts={DOCKER_HOST_ADDRESS: 'host-gateway'},
+                                             name='instrumentation-ngrok-{}'.format(os.getpid()))
     return container_handle
 
 
-def start_listening(logs_path, standalone_proxy, proxy_remote_addr, listen_seconds, ngrok_auth_token):
+def wait_for_ngrok_tunnel(container_handle, timeout=NGROK_BOOT_TIMEOUT_SECONDS):
     """
-    Starts a docker syslog server and a docker ngrok to allow the fastly service to send logs to it
-    :param string logs_path: the host path where the logs will be saved for later processing
-    :param bool standalone_proxy: whether a standalone proxy is used
-    :param string ngrok_auth_token: the ngrok user authentication token
-    :param string proxy_remote_addr: the ngrok remote address to expose
-    :param integer listen_seconds: optional - the number of seconds to listen for incoming logs
-    :return:
+    Waits until the ngrok container logged that its tunnel started
+    :return bool: whether the tunnel started before the timeout
     """
-    syslog_config_path = path.join(CUR_DIR, 'assets', 'syslog-ng.conf')
-    syslog_container_handle = None
-    ngrok_container_handle = None
-    try:
-        syslog_container_handle = run_syslog_server(logs_path, syslog_config_path)
-        if not standalone_proxy:
-            ngrok_container_handle = run_ngrok(ngrok_auth_token, proxy_remote_addr)
-
-        # sleeping to let service activate and containers finish booting up
-        time.sleep(10)
-        if listen_seconds:
-            cli_util.output('Listening for {} seconds'.format(listen_seconds))
-            time.sleep(listen_seconds)
-        else:
-            user_input('! You can now run the tests. Press any key when the tests finished..')
-            time.sleep(5)
-    finally:
-        if ngrok_container_handle:
-            ngrok_container_handle.stop()
-        if syslog_container_handle:
-            syslog_container_handle.stop()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if NGROK_TUNNEL_STARTED_LOG in container_handle.logs():
+            return True
+        time.sleep(POLL_INTERVAL_SECONDS)
+    return False
+
+
+def wait_until_idle(get_last_activity_time, idle_seconds, deadline=None):
+    """
+    Waits until nothing happened for `idle_seconds`
+    :param function get_last_activity_time: returns the time of the last activity
+    :param float idle_seconds:
+    :param float deadline: optional - the time to stop waiting at anyway
+    :return None:
+    """
+    while deadline is None or time.time() < deadline:
+        if time.time() - get_last_activity_time() >= idle_seconds:
+            return
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def announce_first_log(aggregator, stop_event):
+    while not stop_event.is_set():
+        if aggregator.first_log_event.wait(POLL_INTERVAL_SECONDS):
+            cli_util.important('First instrumentation log received, the instrumented version is live')
+            return
+
+
+def listen_until_idle(aggregator, stop_when_idle, deadline=None):
+    """
+    Waits for the first instrumentation log, then until no new coverage arrived for `stop_when_idle` seconds
+    :return None:
+    """
+    cli_util.output('Waiting for the first instrumentation log..')
+    while not aggregator.first_log_event.wait(POLL_INTERVAL_SECONDS):
+        if deadline is not None and time.time() >= deadline:
+            return
+    started_at = time.time()
+    cli_util.output('Listening until no new coverage arrives for {} seconds'.format(stop_when_idle))
+    wait_until_idle(lambda: aggregator.last_new_coverage_time or started_at, stop_when_idle, deadline)
+
+
+def wait_for_tests(aggregator, listen_seconds, stop_when_idle, stop_announcing):
+    """
+    Waits for the tests to finish, as the listening options tell
+    :param threading.Event stop_announcing: stops announcing the first log once the user pressed a key
+    :return None:
+    """
+    if stop_when_idle:
+        deadline = time.time() + listen_seconds if listen_seconds else None
+        listen_until_idle(aggregator, stop_when_idle, deadline)
+    elif listen_seconds:
+        cli_util.output('Listening for {} seconds'.format(listen_seconds))
+        time.sleep(listen_seconds)
+    else:
+        announcer = threading.Thread(target=announce_first_log, args=(aggregator, stop_announcing))
+        announcer.daemon = True
+        announcer.start()
+        user_input('! You can now run the tests. Press any key when the tests finished..')
+        stop_announcing.set()
+        # let logs still in flight arrive
+        finished_at = time.time()
+        wait_until_idle(lambda: max(aggregator.last_message_time or 0, finished_at), DRAIN_IDLE_SECONDS,
+                        finished_at + DRAIN_MAX_SECONDS)
 
 
-def collect_logs(logs_path):
+class LogsCollector:
     """
-    Reads the logs from the log path
-    :param string logs_path:
-    :return string: the content of the logs
+    The syslog server receiving the instrumentation logs into an aggregator, exposed through an ngrok docker
+    container unless a standalone proxy is used.
+    It is started before the instrumented version is activated, so a failure to listen happens while nothing
+    is live yet and no log is missed
     """
-    return fs_util.read_file(path.join(logs_path, 'messages'))
+
+    def __init__(self, aggregator, standalone_proxy, proxy_remote_addr, ngrok_auth_token,
+                 syslog_port=DEFAULT_SYSLOG_PORT):
+        """
+        :param logs_processor.CoverageAggregator aggregator: receives the incoming logs
+        :param bool standalone_proxy: whether a standalone proxy is used
+        :param string proxy_remote_addr: the ngrok remote address to expose
+        :param string ngrok_auth_token: the ngrok user authentication token
+        :param integer syslog_port: the local port of the syslog server
+        """
+        self.aggregator = aggregator
+        self.standalone_proxy = standalone_proxy
+        self.proxy_remote_addr = proxy_remote_addr
+        self.ngrok_auth_token = ngrok_auth_token
+        self.syslog_port = syslog_port
+        self.syslog_receiver = None
+        self.ngrok_container_handle = None
+
+    def start(self):
+        """
+        Starts the syslog server and the ngrok container, once this returns logs are received
+        :return None:
+        """
+        self.syslog_receiver = run_syslog_server(self.aggregator.add_message, self.syslog_port)
+        cli_util.output('Syslog server listening on port {}'.format(self.syslog_receiver.port))
+        if not self.standalone_proxy:
+            with metrics_util.registry.phase('ngrok_boot'):
+                self.ngrok_container_handle = run_ngrok(self.ngrok_auth_token, self.proxy_remote_addr,
+                                                        self.syslog_receiver.port)
+                tunnel_started = wait_for_ngrok_tunnel(self.ngrok_container_handle)
+            if not tunnel_started:
+                cli_util.error('ngrok did not report its tunnel as started, logs may not arrive')
+
+    def stop(self):
+        if self.ngrok_container_handle:
+            self.ngrok_container_handle.stop()
+            self.ngrok_container_handle = None
+        if self.syslog_receiver:
+            self.syslog_receiver.stop()
+            self.syslog_receiver = None
+
+
+def listen(aggregator, listen_seconds=None, stop_when_idle=None, wait=None):
+    """
+    Waits for the logs of the tests while a `LogsCollector` receives them
+    :param logs_processor.CoverageAggregator aggregator: receives the incoming logs
+    :param integer listen_seconds: optional - the number of seconds to listen for incoming logs
+    :param integer stop_when_idle: optional - stop once no new coverage arrived for this number of seconds
+    :param function wait: optional - called with the aggregator, waits for the logs instead of the
+    listening options
+    :return None:
+    """
+    stop_announcing = threading.Event()
+    try:
+        with metrics_util.registry.phase('listen'):
+            if wait:
+                wait(aggregator)
+            else:
+                wait_for_tests(aggregator, listen_seconds, stop_when_idle, stop_announcing)
+    finally:
+        stop_announcing.set()
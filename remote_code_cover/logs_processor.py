@@ -1,45 +1,244 @@
 import re
-from .utils import cli_util
+import threading
+import time
+from collections import Counter, defaultdict
+from .constants import REQUEST_PAYLOAD_SEPARATOR
+from .utils import bitset_util, cli_util, fs_util
 
+INSTR_PATTERN = re.compile(r'\[INSTR\] (.*)')
+# the most distinct payloads an aggregator keeps decoded, beyond it new payloads are decoded on every arrival
+DECODED_PAYLOADS_MAX_SIZE = 100000
 
-def process_entry(log_line):
+
+def process_bitmask_entry(log_line, subroutine_lines):
+    """
+    Decodes a bitmask encoded log line, `name:subroutine index:hex digits`.
+    The n-th hex digit holds the bits of the n-th group of the subroutine tested lines
+    :param string log_line: line of log
+    :param dict subroutine_lines: key: name, value: the tested line numbers of every subroutine of the file
+    :return string, list(integer): the name and the covered line numbers, or None for a malformed line
+    """
+    parts = log_line.rsplit(':', 2)
+    try:
+        name, sub_index, hex_digits = parts
+        sub_tested_line_numbers = subroutine_lines[name][int(sub_index)]
+        # reversed, the first digit becomes the lowest one, so bit N stands for the N-th tested line
+        positions = bitset_util.to_line_numbers(int(hex_digits[::-1], 16)) if hex_digits else []
+        return name, [sub_tested_line_numbers[position] for position in positions]
+    except (ValueError, KeyError, IndexError):
+        cli_util.error('Invalid formatting for result: {}'.format(parts))
+        return None
+
+
+def process_entry(log_line, subroutine_lines=None):
     """
     Given a log line from the logs, extracts the name of the file and line numbers that were covered
     :param string log_line: line of log
-    :return list({'name': string, 'line': integer}):
+    :param dict subroutine_lines: optional - the subroutines tested line numbers by name, needed to
+    decode bitmask encoded log lines
+    :return string, list(integer): the name and the covered line numbers, or None for a malformed line
     """
-    processed_logs = []
+    if ',' not in log_line and ':' in log_line:
+        return process_bitmask_entry(log_line, subroutine_lines or {})
+
     pair = log_line.split(',')
     if len(pair) != 2:
         cli_util.error('Invalid formatting for result: {}'.format(pair))
-        return []
+        return None
 
     name = pair[0]
-    lines = pair[1].split(' ')
-    for line in lines:
-        if line != '':
-            processed_logs.append({'name': name, 'line': int(line)})
+    try:
+        lines = [int(line) for line in pair[1].split(' ') if line != '']
+    except ValueError:
+        cli_util.error('Invalid formatting for result: {}'.format(pair))
+        return None
+    return name, lines
 
-    return processed_logs
+
+def split_payloads(log_line):
+    """
+    :param string log_line:
+    :return list(string): the [INSTR] payloads of a log line, a request log holds the payloads of many subroutines
+    """
+    match = INSTR_PATTERN.search(log_line)
+    if not match:
+        return []
+    return [payload.strip() for payload in match.group(1).split(REQUEST_PAYLOAD_SEPARATOR) if payload.strip()]
+
+
+def iter_payloads(log_lines):
+    """
+    Lazily extracts the [INSTR] payloads out of log lines
+    :param iterable(string) log_lines:
+    :return generator(string):
+    """
+    for log_line in log_lines:
+        for payload in split_payloads(log_line):
+            yield payload
 
 
-def process_logs(logs):
+def process_logs(logs, aggregator=None):
     """
-    Given logs contents, returns a
-    :param string logs: the log contents to process
-    :return list({'name': string, 'line': integer}):
+    Given the logs, folds their coverage into an aggregator.
+    Identical payloads are collapsed into a counted table first, so every distinct payload is decoded once
+    :param iterable(string) logs: the log lines to process, a string is split into its lines
+    :param CoverageAggregator aggregator: optional - the aggregator to add the coverage to
+    :return CoverageAggregator:
     """
-    pattern = r'\[INSTR\] (.*)'
-    matches = re.finditer(pattern, logs)
-    processed_logs = []
-    for match in matches:
-        if len(match.groups()) != 1:
-            cli_util.error('Invalid matching for result: {}'.format(match.groups()))
-            continue
+    if aggregator is None:
+        aggregator = CoverageAggregator()
+    if isinstance(logs, str):
+        logs = logs.splitlines()
+
+    aggregator.add_payload_counts(Counter(iter_payloads(logs)))
+
+    return aggregator
+
+
+def process_log_file(filename, aggregator=None):
+    """
+    Streams a syslog file into an aggregator, peak memory does not depend on the file size
+    :param string filename:
+    :param CoverageAggregator aggregator: optional - the aggregator to add the coverage to
+    :return CoverageAggregator:
+    """
+    return process_logs(fs_util.read_lines(filename), aggregator)
+
+
+class CoverageAggregator:
+    """
+    Accumulates the covered lines out of syslog messages as they arrive.
+    Each name keeps a single bitset of its covered lines, so memory is bounded by the number of instrumented lines.
+    Payloads are decoded once, so parsing time scales with the number of distinct payloads rather than of messages.
+    When `count_hits` is set, the number of logged executions of every line is counted as well.
+    The instrumentation mapping is needed to decode bitmask encoded logs
+    """
+
+    def __init__(self, count_hits=False, instrumentation_mapping=None):
+        self.lock = threading.Lock()
+        self.subroutine_lines = dict(
+            (str(vcl_mapping['name_mapping']), [sub['tested_line_numbers'] for sub in vcl_mapping['subroutines']])
+            for vcl_mapping in (instrumentation_mapping or {}).values())
+        self.covered_lines = defaultdict(int)
+        self.hit_counts = defaultdict(Counter) if count_hits else None
+        self.message_count = 0
+        self.malformed_count = 0
+        # set once the first instrumentation log arrived, proving the instrumented version is live
+        self.first_log_event = threading.Event()
+        self.last_message_time = None
+        self.last_new_coverage_time = None
+        # key: a payload, value: its decoded form, so repeated payloads are parsed once
+        self.decoded_payloads = {}
+
+    def add_message(self, message):
+        """
+        Adds the coverage of a single raw syslog message, messages without an [INSTR] payload are ignored
+        :param string message:
+        :return None:
+        """
+        payloads = split_payloads(message)
+        if payloads:
+            self.add_payload_counts(Counter(payloads))
+
+    def add_payload(self, payload, count=1):
+        """
+        :param string payload: the [INSTR] payload, `name,line line ..` or `name:subroutine index:hex digits`
+        :param integer count: the number of times the payload was logged
+        :return None:
+        """
+        self.add_payload_counts({payload: count})
+
+    def add_payload_counts(self, payload_counts):
+        """
+        Adds a counted table of payloads, every distinct payload is decoded once
+        :param dict payload_counts: key: the [INSTR] payload, value: the number of times it was logged
+        :return None:
+        """
+        decoded_payloads = [(self.decode_payload(payload), count) for payload, count in payload_counts.items()]
+        if not decoded_payloads:
+            return
+        now = time.time()
+        with self.lock:
+            for decoded_payload, count in decoded_payloads:
+                if decoded_payload is None:
+                    self.malformed_count += count
+                    continue
+                name, lines, lines_bitset = decoded_payload
+                self.message_count += count
+                self.last_message_time = now
+                if lines_bitset & ~self.covered_lines[name]:
+                    self.last_new_coverage_time = now
+                self.covered_lines[name] |= lines_bitset
+                if self.hit_counts is not None:
+                    self.hit_counts[name].update(dict.fromkeys(lines, count) if count > 1 else lines)
+        if self.message_count:
+            self.first_log_event.set()
+
+    def decode_payload(self, payload):
+        """
+        Decodes a payload once, repeats of it are served from the decoded payloads.
+        Malformed payloads are remembered as well, so they are reported once
+        :param string payload:
+        :return string, list(integer), integer: the name, the covered line numbers and their bitset,
+        or None for a malformed payload
+        """
+        try:
+            return self.decoded_payloads[payload]
+        except KeyError:
+            pass
+        entry = process_entry(payload, self.subroutine_lines)
+        decoded_payload = None if entry is None else (entry[0], entry[1], bitset_util.from_line_numbers(entry[1]))
+        with self.lock:
+            if len(self.decoded_payloads) < DECODED_PAYLOADS_MAX_SIZE:
+                self.decoded_payloads[payload] = decoded_payload
+        return decoded_payload
+
+    def get_results(self):
+        """
+        :return dict: the aggregated coverage as plain picklable values, to be merged into another aggregator
+        """
+        with self.lock:
+            return {
+                'covered_lines': dict(self.covered_lines),
+                'hit_counts': dict(self.hit_counts) if self.hit_counts is not None else None,
+                'message_count': self.message_count,
+                'malformed_count': self.malformed_count,
+            }
 
-        match_group = match.groups()[0]
-        line_dicts = process_entry(match_group)
-        if line_dicts:
-            processed_logs += line_dicts
+    def pop_results(self, into=None):
+        """
+        Takes the aggregated coverage out of the aggregator, which starts over empty.
+        The decoded payloads are kept, so repeated payloads are still parsed once
+        :param CoverageAggregator into: optional - an aggregator to merge the results into while holding the lock,
+        so a reader locking both aggregators in the same order never sees the results in neither
+        :return dict: the aggregated coverage, see `get_results`
+        """
+        with self.lock:
+            results = {
+                'covered_lines': dict(self.covered_lines),
+                'hit_counts': dict(self.hit_counts) if self.hit_counts is not None else None,
+                'message_count': self.message_count,
+                'malformed_count': self.malformed_count,
+            }
+            if into is not None:
+                into.merge_results(results)
+            self.covered_lines = defaultdict(int)
+            self.hit_counts = defaultdict(Counter) if self.hit_counts is not None else None
+            self.message_count = 0
+            self.malformed_count = 0
+        return results
 
-    return processed_logs
+    def merge_results(self, results):
+        """
+        Adds the coverage aggregated by another aggregator
+        :param dict results: as returned by `get_results`
+        :return None:
+        """
+        with self.lock:
+            for name, lines_bitset in results['covered_lines'].items():
+                self.covered_lines[name] |= lines_bitset
+            if self.hit_counts is not None and results['hit_counts']:
+                for name, line_hits in results['hit_counts'].items():
+                    self.hit_counts[name].update(line_hits)
+            self.message_count += results['message_count']
+            self.malformed_count += results['malformed_count']
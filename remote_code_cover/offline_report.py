@@ -0,0 +1,73 @@
+import multiprocessing
+from . import instrumentator, logs_processor, reporter
+from .utils import cli_util, concurrency_util, fs_util, metrics_util
+
+
+def get_decoding_mapping(instrumentation_mapping):
+    """
+    The part of the instrumentation mapping needed to decode the logs, without the sources
+    :return dict:
+    """
+    return dict((name, {'name_mapping': vcl_mapping['name_mapping'], 'subroutines': vcl_mapping['subroutines']})
+                for name, vcl_mapping in instrumentation_mapping.items())
+
+
+def process_log_file_task(task):
+    """
+    Aggregates the coverage of a single log file, runs in the process pool
+    :param tuple task: the log file name, the decoding mapping and whether to count hits
+    :return dict: the aggregated results, see `CoverageAggregator.get_results`
+    """
+    filename, decoding_mapping, count_hits = task
+    aggregator = logs_processor.process_log_file(filename, logs_processor.CoverageAggregator(count_hits,
+                                                                                            decoding_mapping))
+    return aggregator.get_results()
+
+
+def aggregate_log_files(log_paths, instrumentation_mapping, count_hits=False, workers=None):
+    """
+    Aggregates the coverage of syslog files, every file in a process of its own.
+    Rotated and gzip, bz2 or xz compressed files are supported, directories are read recursively
+    :param list(string) log_paths: log files and directories
+    :param dict instrumentation_mapping:
+    :param bool count_hits:
+    :param integer workers: optional - the number of processes, defaults to the number of CPUs
+    :return logs_processor.CoverageAggregator:
+    """
+    filenames = fs_util.list_files(log_paths)
+    decoding_mapping = get_decoding_mapping(instrumentation_mapping)
+    aggregator = logs_processor.CoverageAggregator(count_hits, decoding_mapping)
+    tasks = [(filename, decoding_mapping, count_hits) for filename in filenames]
+    for results in concurrency_util.process_map(process_log_file_task, tasks, workers or multiprocessing.cpu_count()):
+        aggregator.merge_results(results)
+    metrics_util.registry.increment('log_files_processed', len(filenames))
+    return aggregator
+
+
+def run_report(mapping_filename, log_paths, output_dir=reporter.REPORT_DIR, hit_counts=False, workers=None,
+               lcov_out=None, cobertura_out=None):
+    """
+    Builds a coverage report out of syslog files collected outside of rcc
+    :param string mapping_filename: the instrumentation mapping saved by the run that deployed the instrumentation
+    :param list(string) log_paths: log files and directories
+    :param string output_dir: the report directory
+    :param bool hit_counts: whether to count the executions of every line
+    :param integer workers: optional - the number of processes parsing the logs
+    :param string lcov_out: optional - a file to export the coverage to in the LCOV format
+    :param string cobertura_out: optional - a file to export the coverage to in the Cobertura format
+    :return None:
+    """
+    try:
+        instrumentation_mapping = instrumentator.read_mapping(mapping_filename)
+        with metrics_util.registry.phase('parse'):
+            aggregator = aggregate_log_files(log_paths, instrumentation_mapping, hit_counts, workers)
+        cli_util.output('Processed {} instrumentation logs ({} malformed)'.format(aggregator.message_count,
+                                                                                aggregator.malformed_count))
+
+        coverage_object = reporter.calculate_coverage(instrumentation_mapping, aggregator.covered_lines,
+                                                      aggregator.hit_counts)
+        with metrics_util.registry.phase('report'):
+            reporter.write_report(coverage_object, output_dir, lcov_out, cobertura_out)
+
+    except Exception as err:
+        cli_util.exception_format(err)
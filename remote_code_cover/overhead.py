@@ -0,0 +1,222 @@
+import json
+from . import instrumentator
+from .constants import SYSLOG_INSTRUMENTATION_NAME, LOG_ENCODING_LINES, LOG_ENCODING_BITMASK, BITMASK_GROUP_SIZE, \
+    LOG_MODE_SUBROUTINE, LOG_MODE_REQUEST, REQUEST_PAYLOAD_SEPARATOR, FETCH_SUBROUTINES
+from .utils import cli_util, fs_util
+
+OVERHEAD_FILE_NAME = 'overhead.json'
+# the length of a Fastly service id, logged ahead of every instrumentation message
+SERVICE_ID_LENGTH = 22
+# what every instrumentation message starts with, ahead of the payload
+LOG_MESSAGE_PREFIX_SIZE = len('{} {} :: [INSTR] '.format('x' * SERVICE_ID_LENGTH, SYSLOG_INSTRUMENTATION_NAME))
+# the statements drawing the sampling decision at the start of every subroutine, an if and a set
+SAMPLING_STATEMENT_COUNT = 2
+# in the request log mode, the statements logging a request header and clearing it at every exit of the subroutines
+# logging the coverage of the request, an if, the log and an unset
+FLUSH_STATEMENT_COUNT = 3
+# and at the end of the request, the statements merging what is left of the fetch coverage, an if, a set and an unset
+FETCH_MERGE_STATEMENT_COUNT = 3
+# the budgets a run can be limited by, see `check_budgets`
+BUDGETS = ('max_size_growth_percentage', 'max_request_log_bytes', 'max_subroutine_statements')
+
+
+def get_payload_size(name_mapping, sub_index, sub_tested_line_numbers, log_encoding=LOG_ENCODING_LINES):
+    """
+    :return integer: the size of the payload of a subroutine when all its tested lines are covered
+    """
+    if log_encoding == LOG_ENCODING_BITMASK:
+        group_count = (len(sub_tested_line_numbers) + BITMASK_GROUP_SIZE - 1) // BITMASK_GROUP_SIZE
+        return len('{}:{}:'.format(name_mapping, sub_index)) + group_count
+    return len('{},'.format(name_mapping)) + sum(len(str(line)) + 1 for line in sub_tested_line_numbers)
+
+
+def get_subroutine_overhead(name_mapping, sub_index, subroutine, log_encoding=LOG_ENCODING_LINES,
+                            log_mode=LOG_MODE_SUBROUTINE, sample_rate=None, request_log_subroutines=None):
+    """
+    :param dict subroutine: a subroutine of the instrumentation mapping
+    :param list(string) request_log_subroutines: optional - in the request log mode, the subroutines logging the
+    coverage of the request, see `instrumentator.get_request_log_subroutines`
+    :return dict: the statements and locals the instrumentation adds to the subroutine, its log statements
+    and the most bytes a single run of it logs
+    """
+    tested_line_count = len(subroutine['tested_line_numbers'])
+    if log_encoding == LOG_ENCODING_BITMASK:
+        local_count = (tested_line_count + BITMASK_GROUP_SIZE - 1) // BITMASK_GROUP_SIZE
+    else:
+        local_count = tested_line_count
+    payload_size = get_payload_size(name_mapping, sub_index, subroutine['tested_line_numbers'], log_encoding)
+    exit_count = subroutine['exit_count']
+    added_statements = tested_line_count + local_count + exit_count + \
+        (SAMPLING_STATEMENT_COUNT if sample_rate is not None else 0)
+    if log_mode == LOG_MODE_REQUEST:
+        # appended to the coverage of the request, logged once per request
+        log_bytes = payload_size + len(REQUEST_PAYLOAD_SEPARATOR)
+        fetch = subroutine['name'] in FETCH_SUBROUTINES
+        log_statements = 0
+        if subroutine['name'] in (request_log_subroutines or []):
+            log_statements = exit_count
+            added_statements += exit_count * (FLUSH_STATEMENT_COUNT + (0 if fetch else FETCH_MERGE_STATEMENT_COUNT))
+            if fetch:
+                # the fetch coverage is logged in a message of its own, its first payload has no separator
+                log_bytes += LOG_MESSAGE_PREFIX_SIZE - len(REQUEST_PAYLOAD_SEPARATOR)
+    else:
+        log_bytes = LOG_MESSAGE_PREFIX_SIZE + payload_size
+        log_statements = exit_count
+    return {
+        'name': subroutine['name'],
+        'line_number': subroutine['line_number'],
+        'added_statements': added_statements,
+        'declared_locals': local_count,
+        'log_statements': log_statements,
+        'log_bytes': log_bytes,
+    }
+
+
+def calc_growth_percentage(size, instrumented_size):
+    return round(100.0 * (instrumented_size - size) / size, 2) if size else 0.0
+
+
+def calculate_overhead(vcls, instr_vcls, instrumentation_mapping, log_encoding=LOG_ENCODING_LINES,
+                       log_mode=LOG_MODE_SUBROUTINE, sample_rate=None):
+    """
+    Statically estimates the overhead of the instrumentation out of the instrumentator output
+    :param list(dict) vcls: the custom vcls
+    :param list(dict) instr_vcls: the instrumented custom vcls
+    :param dict instrumentation_mapping:
+    :param string log_encoding:
+    :param string log_mode:
+    :param float sample_rate: optional
+    :return dict: the overhead of every file and subroutine, and their totals. `request_log_bytes` is the most
+    bytes a request running every instrumented subroutine once logs. Sampling only skips the logs: the added
+    statements run for every request, and only `expected_request_log_bytes` is scaled by the sample rate
+    """
+    request_log_subroutines = instrumentator.get_request_log_subroutines(vcls) if log_mode == LOG_MODE_REQUEST \
+        else None
+    instrumented_contents = dict((vcl['name'], vcl['content']) for vcl in instr_vcls)
+    overhead = {'files': [], 'log_encoding': log_encoding, 'log_mode': log_mode, 'sample_rate': sample_rate}
+    totals = dict((key, 0) for key in ('size', 'instrumented_size', 'added_statements', 'declared_locals',
+                                       'log_statements', 'request_log_bytes'))
+    for vcl in vcls:
+        vcl_mapping = instrumentation_mapping.get(vcl['name'])
+        subroutines = [get_subroutine_overhead(vcl_mapping['name_mapping'], sub_index, subroutine, log_encoding,
+                                               log_mode, sample_rate, request_log_subroutines)
+                       for sub_index, subroutine in enumerate(vcl_mapping['subroutines'])] if vcl_mapping else []
+        file_overhead = {
+            'name': vcl['name'],
+            'size': len(vcl['content']),
+            'instrumented_size': len(instrumented_contents[vcl['name']]),
+            'added_statements': sum(sub['added_statements'] for sub in subroutines),
+            'declared_locals': sum(sub['declared_locals'] for sub in subroutines),
+            'log_statements': sum(sub['log_statements'] for sub in subroutines),
+            'request_log_bytes': sum(sub['log_bytes'] for sub in subroutines),
+            'subroutines': subroutines,
+        }
+        file_overhead['size_growth_percentage'] = calc_growth_percentage(file_overhead['size'],
+                                                                         file_overhead['instrumented_size'])
+        overhead['files'].append(file_overhead)
+        for key in totals:
+            totals[key] += file_overhead[key]
+
+    if log_mode == LOG_MODE_REQUEST and totals['request_log_bytes']:
+        # the message of the request, its first payload has no separator
+        totals['request_log_bytes'] += LOG_MESSAGE_PREFIX_SIZE - len(REQUEST_PAYLOAD_SEPARATOR)
+    totals['size_growth_percentage'] = calc_growth_percentage(totals['size'], totals['instrumented_size'])
+    totals['max_subroutine_statements'] = max([sub['added_statements'] for file_overhead in overhead['files']
+                                               for sub in file_overhead['subroutines']] or [0])
+    if sample_rate is not None:
+        totals['expected_request_log_bytes'] = round(totals['request_log_bytes'] * sample_rate, 2)
+    overhead['global'] = totals
+    return overhead
+
+
+def check_budgets(overhead, budgets=None):
+    """
+    :param dict overhead: as returned by `calculate_overhead`
+    :param dict budgets: optional - the limits by name, see `BUDGETS`, unset limits are not checked
+    :return list(string): the exceeded budgets
+    """
+    budgets = budgets or {}
+    totals = overhead['global']
+    measures = {
+        'max_size_growth_percentage': ('VCL size growth', totals['size_growth_percentage'], '%'),
+        'max_request_log_bytes': ('worst case syslog bytes per request', totals['request_log_bytes'], ' bytes'),
+        'max_subroutine_statements': ('statements added to a subroutine', totals['max_subroutine_statements'], ''),
+    }
+    exceeded = []
+    for budget in BUDGETS:
+        limit = budgets.get(budget)
+        description, value, unit = measures[budget]
+        if limit is not None and value > limit:
+            exceeded.append('{} is {}{}, over the budget of {}{}'.format(description, value, unit, limit, unit))
+    return exceeded
+
+
+def print_overhead(overhead):
+    """
+    Prints the overhead of every instrumented file and the totals
+    :param dict overhead: as returned by `calculate_overhead`
+    :return None:
+    """
+    row_format = '{:<30} {:>9} {:>10} {:>7} {:>5} {:>10}'
+    cli_util.output(row_format.format('File', 'Growth', 'Statements', 'Locals', 'Logs', 'Log bytes'))
+    for file_overhead in overhead['files'] + [dict(overhead['global'], name='Total')]:
+        cli_util.output(row_format.format(file_overhead['name'][:30],
+                                          '{}%'.format(file_overhead['size_growth_percentage']),
+                                          file_overhead['added_statements'], file_overhead['declared_locals'],
+                                          file_overhead['log_statements'], file_overhead['request_log_bytes']))
+    if overhead['sample_rate'] is not None:
+        cli_util.output('Sampling {:g}% of the requests skips the logs of the others, not the added statements, '
+                        'expecting {} log bytes per request'.format(overhead['sample_rate'] * 100,
+                                                                    overhead['global']['expected_request_log_bytes']))
+
+
+def write_overhead(overhead, filename):
+    """
+    :param dict overhead: as returned by `calculate_overhead`
+    :param string filename:
+    :return None:
+    """
+    fs_util.write_file(filename, json.dumps(overhead, indent=2, sort_keys=True))
+
+
+def enforce_budgets(overhead, budgets=None):
+    """
+    Prints the overhead and fails when it exceeds a budget
+    :param dict overhead: as returned by `calculate_overhead`
+    :param dict budgets: optional - see `check_budgets`
+    :return None:
+    """
+    print_overhead(overhead)
+    exceeded = check_budgets(overhead, budgets)
+    if exceeded:
+        raise Exception('The instrumentation overhead exceeds its budget: {}'.format('; '.join(exceeded)))
+
+
+def run_overhead(vcl_paths, log_encoding=LOG_ENCODING_LINES, log_mode=LOG_MODE_SUBROUTINE, sample_rate=None,
+                 filters=None, budgets=None, output=None):
+    """
+    Instruments local VCL files and reports the overhead of the instrumentation, without deploying anything
+    :param list(string) vcl_paths: VCL files and directories, every file is a custom vcl named after the file
+    :param string log_encoding:
+    :param string log_mode:
+    :param float sample_rate: optional
+    :param dict filters: optional - see `instrumentator.filter_subroutines`
+    :param dict budgets: optional - see `check_budgets`
+    :param string output: optional - a json file to write the overhead to
+    :return bool: whether the overhead is within the budgets
+    """
+    try:
+        vcls = instrumentator.read_vcl_files(vcl_paths)
+        instr_vcls, instrumentation_mapping = instrumentator.instrument(
+            vcls, log_encoding, sample_rate, log_mode=log_mode,
+            instrumented_subroutines=instrumentator.filter_subroutines(vcls, filters))
+        overhead = calculate_overhead(vcls, instr_vcls, instrumentation_mapping, log_encoding, log_mode,
+                                      sample_rate)
+        if output:
+            write_overhead(overhead, output)
+        enforce_budgets(overhead, budgets)
+        return True
+
+    except Exception as err:
+        cli_util.exception_format(err)
+        return False
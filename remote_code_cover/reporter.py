@@ -1,12 +1,23 @@
 from os import path
-import json
-from collections import defaultdict
+import heapq
+import math
+import multiprocessing
+import time
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
 from pygments.formatters import HtmlFormatter
-from .utils import fs_util, string_util
+from . import exporters
+from .utils import bitset_util, cache_util, cli_util, concurrency_util, fs_util, metrics_util, string_util
 
 CUR_DIR = path.dirname(__file__)
+HEAT_LEVELS = 5
+# below this number of files, rendering in the current process is faster than starting a process pool
+PARALLEL_REPORT_MIN_FILES = 8
+REPORT_DIR = 'coverage'
+MANIFEST_FILE_NAME = 'manifest.json'
+# bump when the rendering changes, so reports written by older versions are fully regenerated
+REPORT_FORMAT_VERSION = 3
+SOURCE_CODE_START = '<td class="code"><div class="source"><pre>'
 
 
 def calc_percentage(nominator, denominator, ndigits=2):
@@ -15,20 +26,47 @@ def calc_percentage(nominator, denominator, ndigits=2):
     return round(float(nominator) * 100 / denominator, ndigits)
 
 
-def calculate_coverage(instrumentation_mappings, processed_logs):
+def calculate_hit_counts(file_coverage, vcl_mapping, file_hit_counts, hottest_count):
+    """
+    Adds the hit counts of the covered lines, the subroutines and the hottest lines to a file coverage
+    :param dict file_coverage: the file coverage to update
+    :param dict vcl_mapping: the instrumentation mapping of the file
+    :param dict file_hit_counts: key: line number, value: number of logged executions
+    :param integer hottest_count: the number of hottest lines to keep
+    :return None:
+    """
+    line_hits = dict((line, file_hit_counts.get(line, 0)) for line in file_coverage['covered_line_numbers'])
+    source_lines = file_coverage['original_content'].split('\n')
+    file_coverage['hit_counts'] = line_hits
+    file_coverage['subroutines'] = [{
+        'file': file_coverage['name'],
+        'name': subroutine['name'],
+        'line_number': subroutine['line_number'],
+        'hits': sum(line_hits.get(line, 0) for line in subroutine['tested_line_numbers']),
+    } for subroutine in vcl_mapping.get('subroutines', [])]
+    hottest_lines = heapq.nlargest(hottest_count, line_hits.items(), key=lambda line_hit: line_hit[1])
+    file_coverage['hottest_lines'] = [{
+        'file': file_coverage['name'],
+        'line': line,
+        'hits': hits,
+        'source': source_lines[line - 1].strip(),
+    } for line, hits in hottest_lines]
+
+
+def calculate_coverage(instrumentation_mappings, covered_lines, hit_counts=None, hottest_count=10, metadata=None):
     """
     Given the parameters, returns a coverage object that contains the needed data for the report
     :param dict instrumentation_mappings: a dictionary of
     key: name, value: properties that includes instrumentation mappings
-    :param list processed_logs: a list of processed logs that contain the coverage information
+    :param dict covered_lines: the aggregated coverage information,
+    key: name mapping, value: a bitset of the covered line numbers
+    :param dict hit_counts: optional - the aggregated hit counts,
+    key: name mapping, value: a dictionary of line number to its number of logged executions
+    :param integer hottest_count: the number of hottest lines and subroutines to report with hit counts
+    :param dict metadata: optional - properties of the run to show in the report, e.g. the sample rate
     :return dict: coverage object
     """
 
-    # Removing duplicate lines
-    logs_by_name_line = defaultdict(dict)
-    for log_line in processed_logs:
-        logs_by_name_line[log_line['name']][log_line['line']] = log_line
-
     coverage_object = {}
     files = {}
     global_tested_line_count = 0
@@ -36,11 +74,12 @@ def calculate_coverage(instrumentation_mappings, processed_logs):
     for name, vcl_mapping in instrumentation_mappings.items():
         tested_line_count = vcl_mapping['tested_line_count']
         original_content = vcl_mapping['original_content']
-        logs = logs_by_name_line[str(vcl_mapping['name_mapping'])]
-        covered_line_numbers = list(logs.keys())
-        covered_line_count = len(logs)
         tested_line_numbers = vcl_mapping['tested_line_numbers']
-        uncovered_line_numbers = [line for line in tested_line_numbers if line not in covered_line_numbers]
+        tested_lines = bitset_util.from_line_numbers(tested_line_numbers)
+        covered = covered_lines.get(str(vcl_mapping['name_mapping']), 0) & tested_lines
+        covered_line_numbers = bitset_util.to_line_numbers(covered)
+        covered_line_count = len(covered_line_numbers)
+        uncovered_line_numbers = bitset_util.to_line_numbers(tested_lines & ~covered)
         files[name] = {
             'name': name,
             'coverage_line_percentage': calc_percentage(covered_line_count, tested_line_count),
@@ -52,19 +91,40 @@ def calculate_coverage(instrumentation_mappings, processed_logs):
             'uncovered_line_numbers': uncovered_line_numbers,
             'covered_line_numbers': covered_line_numbers
         }
+        if hit_counts is not None:
+            calculate_hit_counts(files[name], vcl_mapping, hit_counts.get(str(vcl_mapping['name_mapping']), {}),
+                                 hottest_count)
         global_tested_line_count += tested_line_count
         global_covered_line_count += covered_line_count
 
     coverage_object['files'] = files
+    coverage_object['metadata'] = metadata or {}
     coverage_object['global'] = {
         'coverage_line_percentage': calc_percentage(global_covered_line_count, global_tested_line_count),
         'covered_line_count': global_covered_line_count,
         'tested_line_count': global_tested_line_count,
     }
+    if hit_counts is not None:
+        coverage_object['hottest_lines'] = heapq.nlargest(
+            hottest_count, [line for f in files.values() for line in f['hottest_lines']], key=lambda l: l['hits'])
+        coverage_object['hottest_subroutines'] = heapq.nlargest(
+            hottest_count, [sub for f in files.values() for sub in f['subroutines']], key=lambda s: s['hits'])
 
     return coverage_object
 
 
+def hits_to_heat_level(hits, max_hits):
+    """
+    Maps a hit count to a heat level between 1 and HEAT_LEVELS on a logarithmic scale
+    :param integer hits:
+    :param integer max_hits: the highest hit count in the report
+    :return integer:
+    """
+    if max_hits <= 1 or hits <= 1:
+        return 1
+    return 1 + int(round((HEAT_LEVELS - 1) * math.log(hits) / math.log(max_hits)))
+
+
 def coverage_percentage_to_level(percentage):
     if percentage < 50:
         return 'low'
@@ -73,66 +133,231 @@ def coverage_percentage_to_level(percentage):
     return 'high'
 
 
-def generate_html_report(coverage_object):
+def get_heat_levels(file_coverage, max_hits):
     """
-    Given a coverage object returns an html report
-    :param dict coverage_object:
-    :return list(string), string: html files, css file
+    :param dict file_coverage:
+    :param integer max_hits: the highest hit count in the report
+    :return dict: key: covered line number, value: its heat level, None without hit counts
+    """
+    line_hits = file_coverage.get('hit_counts')
+    if line_hits is None:
+        return None
+    return dict((line, hits_to_heat_level(hits, max_hits)) for line, hits in line_hits.items())
+
+
+def get_max_hits(coverage_object):
+    """
+    :return integer: the highest hit count in the report, 0 without hit counts
+    """
+    hottest_lines = coverage_object.get('hottest_lines')
+    return hottest_lines[0]['hits'] if hottest_lines else 0
+
+
+def highlight_source(file_coverage, heat_levels=None):
+    """
+    Highlights the source code of a file, marking its covered and uncovered lines
+    :param dict file_coverage:
+    :param dict heat_levels: optional - the heat level of every covered line, see `get_heat_levels`
+    :return string: the highlighted html
     """
     lexer = get_lexer_by_name('ruby', stripall=True)
     formatter = HtmlFormatter(linenos=True, cssclass='source')
+    source_lines = highlight(file_coverage['original_content'], lexer, formatter).split('\n')
+    # find the start of the code
+    indices = [i for (i, line) in enumerate(source_lines) if SOURCE_CODE_START in line]
+    if len(indices) != 1:
+        raise Exception('No suitable pre code entries found')
+    offset = indices[0] - 1
+    for line in file_coverage['uncovered_line_numbers']:
+        source_lines[offset + line] = '<span class="uncovered">{}</span>'.format(source_lines[offset + line])
+    line_hits = file_coverage.get('hit_counts')
+    for line in file_coverage['covered_line_numbers']:
+        i = offset + line
+        if line_hits is None:
+            source_lines[i] = '<span class="covered">{}</span>'.format(source_lines[i])
+        else:
+            source_lines[i] = '<span class="covered heat-{}" title="{} hits">{}</span>'.format(
+                heat_levels[line], line_hits[line], source_lines[i])
+    return '\n'.join(source_lines)
+
 
+def render_file_report(task):
+    """
+    Renders the html report of a single file, runs in the report process pool
+    :param tuple task: the source code template, the file coverage, its heat levels and the variables shared by
+    all files
+    :return string, float: the html and the seconds it took to render
+    """
+    start = time.time()
+    source_code_template, file_coverage, heat_levels, shared_variables = task
+    variables = dict(shared_variables)
+    variables.update({
+        'title': '{}.vcl'.format(file_coverage['name']),
+        'file': file_coverage,
+        'source': highlight_source(file_coverage, heat_levels),
+        'coverage_level': file_coverage['coverage_level'],
+    })
+    return string_util.render_template_with_variables(source_code_template, variables), time.time() - start
+
+
+def load_report_assets(coverage_object):
+    """
+    Reads the report assets and prepares the variables shared by all the files of the report
+    :param dict coverage_object:
+    :return string, string, string, dict: css, summary template, source code template, shared variables
+    """
     assets_dir = path.join(CUR_DIR, 'assets')
     css = fs_util.read_file(path.join(assets_dir, 'highlight.css'))
     summary_template = fs_util.read_file(path.join(assets_dir, 'summary.jinja2'))
     source_code_template = fs_util.read_file(path.join(assets_dir, 'code_cover.jinja2'))
-    html_files = {}
-    file_names = coverage_object['files'].keys()
-    for file_name, file_coverage in coverage_object['files'].items():
-        source = highlight(file_coverage['original_content'], lexer, formatter)
-        source_lines = source.split('\n')
-        # find the start of the code
-        indices = [i for (i, line) in enumerate(source_lines) if '<td class="code"><div class="source"><pre>' in line]
-        if len(indices) != 1:
-            raise Exception('No suitable pre code entries found')
-        uncovered_line_numbers_offset = [indices[0] + i - 1 for i in file_coverage['uncovered_line_numbers']]
-        for i in uncovered_line_numbers_offset:
-            source_lines[i] = '<span class="uncovered">{}</span>'.format(source_lines[i])
-        covered_line_numbers_offset = [indices[0] + i - 1 for i in file_coverage['covered_line_numbers']]
-        for i in covered_line_numbers_offset:
-            source_lines[i] = '<span class="covered">{}</span>'.format(source_lines[i])
-        source = '\n'.join(source_lines)
+    shared_variables = {
+        'file_names': list(coverage_object['files'].keys()),
+        'metadata': coverage_object.get('metadata', {}),
+    }
+    for file_coverage in coverage_object['files'].values():
         file_coverage['coverage_level'] = coverage_percentage_to_level(file_coverage['coverage_line_percentage'])
-        result = string_util.render_template_with_variables(source_code_template, {
-            'title': '{}.vcl'.format(file_name),
-            'file_names': file_names,
-            'file': file_coverage,
-            'source': source,
-            'coverage_level': file_coverage['coverage_level'],
-        })
-        html_files[file_name] = result
-
-    html_files['index'] = string_util.render_template_with_variables(summary_template, {
+    return css, summary_template, source_code_template, shared_variables
+
+
+def render_file_reports(source_code_template, file_coverages, file_heat_levels, shared_variables, workers=None):
+    """
+    Renders the html reports of files, with many files in a pool of processes
+    :param string source_code_template:
+    :param list(dict) file_coverages:
+    :param list(dict) file_heat_levels: the heat levels of every file, see `get_heat_levels`
+    :param dict shared_variables:
+    :param integer workers: optional - the number of processes, defaults to the number of CPUs
+    :return list(string): the html of every file, in order
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count() if len(file_coverages) >= PARALLEL_REPORT_MIN_FILES else 1
+    tasks = [(source_code_template, file_coverage, heat_levels, shared_variables)
+             for file_coverage, heat_levels in zip(file_coverages, file_heat_levels)]
+    html_files = []
+    for file_coverage, (html, render_seconds) in zip(file_coverages,
+                                                     concurrency_util.process_map(render_file_report, tasks, workers)):
+        metrics_util.registry.observe('render_file', render_seconds, labels={'file': file_coverage['name']})
+        html_files.append(html)
+    return html_files
+
+
+def get_index_variables(coverage_object, shared_variables):
+    return {
         'global': coverage_object['global'],
-        'files': coverage_object['files'].values(),
-        'file_names': file_names,
+        'metadata': shared_variables['metadata'],
+        'files': list(coverage_object['files'].values()),
+        'file_names': shared_variables['file_names'],
+        'hottest_lines': coverage_object.get('hottest_lines'),
+        'hottest_subroutines': coverage_object.get('hottest_subroutines'),
         'coverage_level': coverage_percentage_to_level(coverage_object['global']['coverage_line_percentage'])
-    })
+    }
+
+
+def generate_html_report(coverage_object, workers=None):
+    """
+    Given a coverage object returns an html report.
+    With many files, the files are highlighted and rendered in a pool of processes
+    :param dict coverage_object:
+    :param integer workers: optional - the number of processes, defaults to the number of CPUs
+    :return list(string), string: html files, css file
+    """
+    css, summary_template, source_code_template, shared_variables = load_report_assets(coverage_object)
+    file_names = shared_variables['file_names']
+    file_coverages = [coverage_object['files'][file_name] for file_name in file_names]
+    max_hits = get_max_hits(coverage_object)
+    file_heat_levels = [get_heat_levels(file_coverage, max_hits) for file_coverage in file_coverages]
+    html_files = dict(zip(file_names, render_file_reports(source_code_template, file_coverages, file_heat_levels,
+                                                          shared_variables, workers)))
+    html_files['index'] = string_util.render_template_with_variables(
+        summary_template, get_index_variables(coverage_object, shared_variables))
 
     return html_files, css
 
 
-def write_html_report(html_files, css, coverage_object):
+def load_manifest(base_path):
+    """
+    :param string base_path: the report directory
+    :return dict: key: output file name, value: the hash of the inputs it was written from
     """
-    Writes the html report to disk
-    :param list(string) html_files:
-    :param string css:
+    manifest = cache_util.load(base_path, path.splitext(MANIFEST_FILE_NAME)[0])
+    if not manifest or manifest.get('version') != REPORT_FORMAT_VERSION:
+        return {}
+    return manifest.get('outputs', {})
+
+
+def write_incremental_html_report(coverage_object, base_path=REPORT_DIR, workers=None):
+    """
+    Writes the html report to disk, rendering and writing only the outputs whose inputs changed since the
+    report last written to `base_path`. A manifest of the inputs hash of every output is kept next to the report.
+    The index is written last, followed by the manifest
     :param dict coverage_object:
-    :return None:
+    :param string base_path: the report directory
+    :param integer workers: optional - the number of rendering processes, defaults to the number of CPUs
+    :return list(string): the names of the files whose html was rendered
     """
-    base_path = path.join('coverage')
+    css, summary_template, source_code_template, shared_variables = load_report_assets(coverage_object)
+    previous_outputs = load_manifest(base_path)
+    outputs = {}
     fs_util.mkdirp(base_path)
-    for file_name, content in html_files.items():
+
+    def is_changed(output_name, *inputs):
+        outputs[output_name] = cache_util.content_hash(REPORT_FORMAT_VERSION, *inputs)
+        return (previous_outputs.get(output_name) != outputs[output_name] or
+                not path.exists(path.join(base_path, output_name)))
+
+    # the heat levels rather than the hit counts of the whole report, so traffic to a file only re-renders that file
+    max_hits = get_max_hits(coverage_object)
+    file_heat_levels = dict((file_name, get_heat_levels(file_coverage, max_hits))
+                            for file_name, file_coverage in coverage_object['files'].items())
+    changed_file_names = [file_name for file_name in shared_variables['file_names']
+                          if is_changed(file_name + '.html', source_code_template,
+                                        coverage_object['files'][file_name], file_heat_levels[file_name],
+                                        shared_variables)]
+    html_files = render_file_reports(source_code_template,
+                                     [coverage_object['files'][file_name] for file_name in changed_file_names],
+                                     [file_heat_levels[file_name] for file_name in changed_file_names],
+                                     shared_variables, workers)
+    for file_name, content in zip(changed_file_names, html_files):
         fs_util.write_file(path.join(base_path, file_name + '.html'), content)
-    fs_util.write_file(path.join(base_path, 'highlight.css'), css)
-    fs_util.write_file(path.join(base_path, 'coverage.json'), json.dumps(coverage_object, indent=2))
+
+    # reports of files that are gone
+    for output_name in previous_outputs:
+        if output_name not in outputs and output_name.endswith('.html') and output_name != 'index.html':
+            fs_util.remove_file(path.join(base_path, output_name))
+
+    if is_changed('highlight.css', css):
+        fs_util.write_file(path.join(base_path, 'highlight.css'), css)
+    if is_changed('coverage.json', coverage_object):
+        exporters.write_coverage_json(coverage_object, base_path)
+    index_variables = get_index_variables(coverage_object, shared_variables)
+    if is_changed('index.html', summary_template, index_variables):
+        fs_util.write_file(path.join(base_path, 'index.html'),
+                           string_util.render_template_with_variables(summary_template, index_variables))
+
+    cache_util.store(base_path, path.splitext(MANIFEST_FILE_NAME)[0],
+                     {'version': REPORT_FORMAT_VERSION, 'outputs': outputs})
+    return changed_file_names
+
+
+def write_report(coverage_object, base_path=REPORT_DIR, lcov_out=None, cobertura_out=None):
+    """
+    Writes the html report and the requested exports of a coverage object
+    :param dict coverage_object:
+    :param string base_path: the report directory
+    :param string lcov_out: optional - a file to export the coverage to in the LCOV format
+    :param string cobertura_out: optional - a file to export the coverage to in the Cobertura format
+    :return string: the absolute path of the report index
+    """
+    rendered_file_names = write_incremental_html_report(coverage_object, base_path)
+    cli_util.output('Rendered {} of {} file reports, the rest did not change'.format(
+        len(rendered_file_names), len(coverage_object['files'])))
+    if lcov_out:
+        exporters.write_lcov(coverage_object, lcov_out)
+        cli_util.output('LCOV report saved to {}'.format(lcov_out))
+    if cobertura_out:
+        exporters.write_cobertura(coverage_object, cobertura_out)
+        cli_util.output('Cobertura report saved to {}'.format(cobertura_out))
+
+    coverage_path = path.abspath(base_path)
+    cli_util.important('Coverage report saved to {}'.format(cli_util.blue_bold(coverage_path)))
+    return path.join(coverage_path, 'index.html')
@@ -0,0 +1,161 @@
+import re
+import sys
+import threading
+from .utils import cli_util, metrics_util
+
+if sys.version_info[0] < 3:
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+RECV_BUFFER_SIZE = 65536
+# an unprivileged port, so the server runs without root
+DEFAULT_PORT = 5140
+OCTET_COUNT_PATTERN = re.compile(br'([1-9][0-9]{0,9}) ')
+LEADING_DIGITS_PATTERN = re.compile(br'[0-9]{1,10}\Z')
+
+
+def split_frames(buffer):
+    """
+    Splits the complete syslog frames off a TCP stream buffer.
+    Both RFC 6587 framing methods are supported: octet-counting (`<length> <message>`)
+    and non-transparent framing (messages terminated by a newline)
+    :param bytes buffer: the received, not yet consumed bytes
+    :return list(bytes), bytes: the complete frames and the unconsumed remainder
+    """
+    frames = []
+    pos = 0
+    length = len(buffer)
+    while pos < length:
+        if buffer[pos:pos + 1] in (b'\n', b'\r', b'\0'):
+            pos += 1
+            continue
+
+        octet_count_match = OCTET_COUNT_PATTERN.match(buffer, pos)
+        if octet_count_match:
+            start = octet_count_match.end()
+            end = start + int(octet_count_match.group(1))
+            if end > length:
+                break
+            frames.append(buffer[start:end])
+            pos = end
+            continue
+
+        if LEADING_DIGITS_PATTERN.match(buffer, pos):
+            # an octet count that was cut in the middle, wait for the rest of it
+            break
+
+        end = buffer.find(b'\n', pos)
+        if end == -1:
+            break
+        frames.append(buffer[pos:end].rstrip(b'\r\0'))
+        pos = end + 1
+
+    return frames, buffer[pos:]
+
+
+def decode_frame(frame):
+    return frame.decode('utf-8', 'replace')
+
+
+def handle_frame(handle_message, frame):
+    """
+    Passes a frame on to the message handler, a message that fails to be handled is reported and dropped
+    so it does not end the connection and the messages following it
+    :param function handle_message:
+    :param bytes frame:
+    :return None:
+    """
+    try:
+        handle_message(decode_frame(frame))
+    except Exception as err:
+        metrics_util.registry.increment('log_messages_failed')
+        cli_util.error('Failed handling syslog message {!r}: {}'.format(frame[:200], err))
+
+
+class SyslogTCPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        handle_message = self.server.handle_message
+        buffer = b''
+        while True:
+            data = self.request.recv(RECV_BUFFER_SIZE)
+            if not data:
+                break
+            metrics_util.registry.increment('log_bytes_received', len(data))
+            frames, buffer = split_frames(buffer + data)
+            for frame in frames:
+                handle_frame(handle_message, frame)
+
+        # the peer closed the connection, whatever is left is the last message
+        buffer = buffer.strip(b'\r\n\0')
+        if buffer:
+            handle_frame(handle_message, buffer)
+
+
+class SyslogUDPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        metrics_util.registry.increment('log_bytes_received', len(self.request[0]))
+        datagram = self.request[0].strip(b'\r\n\0')
+        if datagram:
+            handle_frame(self.server.handle_message, datagram)
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class ThreadingUDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SyslogReceiver:
+    """
+    An in-process syslog server listening on TCP and UDP.
+    Every received message is passed to `handle_message` as soon as it is read off the socket,
+    handlers are called from the server threads and should be thread-safe
+    """
+
+    def __init__(self, handle_message, host='0.0.0.0', port=DEFAULT_PORT, udp=True):
+        self.handle_message = handle_message
+        self.host = host
+        self.port = port
+        self.udp = udp
+        self.servers = []
+        self.threads = []
+
+    def start(self):
+        """
+        Binds the server sockets and starts serving them in background threads.
+        Once this returns the receiver is accepting messages
+        :return None:
+        """
+        tcp_server = ThreadingTCPServer((self.host, self.port), SyslogTCPHandler)
+        self.servers.append(tcp_server)
+        # when binding port 0, use the same port the OS chose for TCP on UDP as well
+        self.port = tcp_server.server_address[1]
+        if self.udp:
+            try:
+                self.servers.append(ThreadingUDPServer((self.host, self.port), SyslogUDPHandler))
+            except Exception:
+                # the port is only half taken, release the TCP one
+                tcp_server.server_close()
+                self.servers = []
+                raise
+
+        for server in self.servers:
+            server.handle_message = self.handle_message
+            thread = threading.Thread(target=server.serve_forever, name='syslog-receiver')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.servers = []
+        self.threads = []
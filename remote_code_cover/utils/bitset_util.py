@@ -0,0 +1,27 @@
+def from_line_numbers(line_numbers):
+    """
+    Packs line numbers into a bitset, bit N is set when line N is in the set
+    :param iterable(integer) line_numbers:
+    :return integer:
+    """
+    bitset = 0
+    for line_number in line_numbers:
+        bitset |= 1 << line_number
+    return bitset
+
+
+def to_line_numbers(bitset):
+    """
+    :param integer bitset:
+    :return list(integer): the sorted line numbers set in the bitset
+    """
+    line_numbers = []
+    while bitset:
+        lowest_bit = bitset & -bitset
+        line_numbers.append(lowest_bit.bit_length() - 1)
+        bitset ^= lowest_bit
+    return line_numbers
+
+
+def count(bitset):
+    return bin(bitset).count('1')
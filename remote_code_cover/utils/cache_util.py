@@ -0,0 +1,40 @@
+import hashlib
+import json
+from os import path
+from . import fs_util
+
+
+def get_default_cache_dir():
+    return path.join(fs_util.get_tmpdir(), 'rcc-cache')
+
+
+def content_hash(*parts):
+    """
+    :param parts: json serializable values
+    :return string: a hex digest identifying the values
+    """
+    serialized = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def load(cache_dir, key):
+    """
+    :param string cache_dir:
+    :param string key: a content hash
+    :return dict: the cached value, or None on a cache miss
+    """
+    try:
+        return json.loads(fs_util.read_file(path.join(cache_dir, key + '.json')))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def store(cache_dir, key, value):
+    """
+    :param string cache_dir:
+    :param string key: a content hash
+    :param dict value: a json serializable value
+    :return None:
+    """
+    fs_util.mkdirp(cache_dir)
+    fs_util.write_file(path.join(cache_dir, key + '.json'), json.dumps(value))
@@ -0,0 +1,43 @@
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+
+def parallel_map(func, items, workers):
+    """
+    Calls `func` on every item in a bounded pool of threads, for I/O bound work such as API calls
+    :param function func:
+    :param list items:
+    :param integer workers: the maximal number of concurrent calls
+    :return list: the results, in the order of the items. The first exception raised by `func` is re-raised
+    """
+    items = list(items)
+    if len(items) <= 1 or workers <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def process_map(func, items, workers):
+    """
+    Calls `func` on every item in a pool of processes, for CPU bound work.
+    `func` has to be a module level function and the items and results picklable
+    :param function func:
+    :param list items:
+    :param integer workers: the maximal number of processes
+    :return list: the results, in the order of the items. The first exception raised by `func` is re-raised
+    """
+    items = list(items)
+    if len(items) <= 1 or workers <= 1:
+        return [func(item) for item in items]
+
+    pool = Pool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
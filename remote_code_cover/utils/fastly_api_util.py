@@ -1,5 +1,9 @@
+import random
 import requests
 import sys
+import time
+from requests.adapters import HTTPAdapter
+from . import metrics_util
 
 if sys.version_info[0] < 3:
     from urllib import urlencode
@@ -7,17 +11,61 @@ else:
     from urllib.parse import urlencode
 
 
+# connections kept open to the api host, at least the number of concurrent requests
+POOL_SIZE = 16
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+# seconds to connect and to wait for a response, a stalled connection fails and is retried instead of hanging
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+# a failed POST may still have been applied, so it is only retried when rate limited. Requests creating a resource
+# with another method, e.g. cloning a version, are marked as not idempotent by their caller
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+
+def is_retryable_status(idempotent, status_code):
+    return status_code == 429 or (status_code >= 500 and idempotent)
+
+
+def get_retry_delay(response, attempt):
+    """
+    :param requests.Response response: the failed response, None when the request did not get one
+    :param integer attempt: the number of the failed attempt, starting from 0
+    :return float: the seconds to wait before retrying. Rate limit headers are honored,
+    otherwise an exponential backoff with jitter is used
+    """
+    headers = response.headers if response is not None else {}
+    if headers.get('Retry-After', '').isdigit():
+        return min(float(headers['Retry-After']), BACKOFF_MAX_SECONDS)
+    if response is not None and response.status_code == 429 and headers.get('Fastly-RateLimit-Reset', '').isdigit():
+        return min(max(float(headers['Fastly-RateLimit-Reset']) - time.time(), 0), BACKOFF_MAX_SECONDS)
+    backoff = min(BACKOFF_BASE_SECONDS * 2 ** attempt, BACKOFF_MAX_SECONDS)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
 class FastlyApiClient:
     api_host = 'https://api.fastly.com'
     auth_token = None
     service_id = None
 
-    def __init__(self, auth_token, service_id):
+    def __init__(self, auth_token, service_id, api_host=None, max_retries=MAX_RETRIES,
+                 timeout=REQUEST_TIMEOUT_SECONDS):
         if len(auth_token) != 32:
             raise Exception('Fastly auth token should be 32 characters. Are you sure you have the correct token?')
 
         self.auth_token = auth_token
         self.service_id = service_id
+        self.max_retries = max_retries
+        self.timeout = timeout
+        if api_host:
+            self.api_host = api_host
+        # a single session keeps the connections to the api host alive between requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def path(self, version=None, suffix=''):
         """
@@ -31,12 +79,17 @@ class FastlyApiClient:
         path += suffix
         return path
 
-    def do_request(self, http_method, uri, params=None, data=None):
+    def do_request(self, http_method, uri, params=None, data=None, idempotent=None):
         """
         Does an API request with the supplied http method (string),
         params (dict), uri (string), data (url_encoded string)
+        Rate limited (429) responses are retried with backoff, and so are server errors (5xx),
+        connection errors and timeouts of idempotent requests.
+        idempotent (bool) defaults to whether the http method is idempotent, see `IDEMPOTENT_METHODS`
         Returns a requests response object.
         """
+        if idempotent is None:
+            idempotent = http_method in IDEMPOTENT_METHODS
         headers = {
             'Fastly-Key': self.auth_token,
             'Accept': 'application/json',
@@ -44,8 +97,26 @@ class FastlyApiClient:
         }
         url = self.api_host + uri
         params = params if params else {}
-        response = requests.request(http_method, url, headers=headers, params=params, data=data)
-        return response
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                response = self.session.request(http_method, url, headers=headers, params=params, data=data,
+                                                timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics_util.registry.increment('api_calls', labels={'method': http_method, 'status': 'error'})
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                response = None
+            else:
+                metrics_util.registry.observe('api_call', time.time() - start, labels={'method': http_method})
+                metrics_util.registry.increment('api_calls', labels={'method': http_method,
+                                                                     'status': response.status_code})
+                if not is_retryable_status(idempotent, response.status_code) or attempt >= self.max_retries:
+                    return response
+            metrics_util.registry.increment('api_retries')
+            time.sleep(get_retry_delay(response, attempt))
+            attempt += 1
 
     def get(self, uri, params=None, data=None):
         return self.do_request('GET', uri, params, data)
@@ -53,8 +124,8 @@ class FastlyApiClient:
     def post(self, uri, params=None, data=None):
         return self.do_request('POST', uri, params, data)
 
-    def put(self, uri, params=None, data=None):
-        return self.do_request('PUT', uri, params, data)
+    def put(self, uri, params=None, data=None, idempotent=True):
+        return self.do_request('PUT', uri, params, data, idempotent)
 
     def delete(self, uri, params=None, data=None):
         return self.do_request('DELETE', uri, params, data)
@@ -69,21 +140,34 @@ class FastlyApiClient:
             raise Exception(msg)
         return True
 
-    def get_active_version(self):
+    def get_versions(self):
         response = self.get(self.path(suffix='/version'))
-        body = response.json()
+        return response.json()
+
+    def get_active_version(self, versions=None):
+        """
+        :param list versions: optional - the service versions, fetched when not given
+        :return integer: the active version number
+        """
         active_version = None
-        for version_obj in body:
+        for version_obj in versions if versions is not None else self.get_versions():
             if version_obj['active']:
                 active_version = version_obj['number']
         return active_version
 
+    def update_version(self, version, data):
+        response = self.put(self.path(version), data=urlencode(data))
+        if response.status_code >= 400:
+            raise Exception('failed to update version {}. Error: {}'.format(version, response.json()))
+        return response.json()
+
     def clone_version(self, version):
         """
         Clones the current active Fastly configuration version
         Returns the version number (int)
         """
-        response = self.put(self.path(version, '/clone'))
+        # every clone creates a new version, a retried clone could leave an orphan draft version behind
+        response = self.put(self.path(version, '/clone'), idempotent=False)
         return response.json()['number']
 
     def create_syslog(self, version, syslog_vcl):
@@ -91,7 +175,7 @@ class FastlyApiClient:
         Create syslog configuration on the Fastly configuration version (int).
         Returns nothing.
         """
-        response = self.post(self.path(version, 'logging/syslog'), params=syslog_vcl)
+        response = self.post(self.path(version, '/logging/syslog'), params=syslog_vcl)
         if response.status_code == 409:
             raise Exception('syslog already exists')
         elif response.status_code >= 400:
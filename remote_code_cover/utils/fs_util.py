@@ -1,9 +1,17 @@
+import bz2
 import errno
+import gzip
+import io
 import os
 import platform
 import subprocess
 import tempfile
 
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
 
 def remove_file(filename):
     try:
@@ -28,11 +36,66 @@ def write_file(filename, contents):
 
 
 def read_file(filename):
-    with open(filename, 'rU') as f:
+    with io.open(filename, 'r') as f:
         data = f.read()
         return data
 
 
+def open_binary(filename):
+    """
+    Opens a file for reading bytes, gzip, bz2 and xz compressed files are decompressed by their extension
+    :param string filename:
+    :return file:
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.gz':
+        return gzip.open(filename, 'rb')
+    if extension == '.bz2':
+        return bz2.BZ2File(filename, 'rb')
+    if extension in ('.xz', '.lzma'):
+        if lzma is None:
+            raise Exception('Reading xz compressed files requires Python 3: {}'.format(filename))
+        return lzma.open(filename, 'rb')
+    return io.open(filename, 'rb')
+
+
+def list_files(paths):
+    """
+    :param list(string) paths: files and directories
+    :return list(string): the files, and the files under the directories recursively, in a stable order
+    """
+    filenames = []
+    for file_path in paths:
+        if os.path.isdir(file_path):
+            for dir_path, _, dir_filenames in sorted(os.walk(file_path)):
+                filenames.extend(os.path.join(dir_path, filename) for filename in sorted(dir_filenames))
+        else:
+            filenames.append(file_path)
+    return filenames
+
+
+def read_lines(filename, chunk_size=1024 * 1024):
+    """
+    Lazily reads a file line by line in fixed size chunks, so memory does not grow with the file size.
+    Compressed files are decompressed on the fly
+    :param string filename:
+    :param integer chunk_size: the number of bytes read at a time
+    :return generator(string): the lines of the file without their line endings
+    """
+    with open_binary(filename) as f:
+        remainder = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line.rstrip(b'\r').decode('utf-8', 'replace')
+        if remainder:
+            yield remainder.rstrip(b'\r').decode('utf-8', 'replace')
+
+
 def open_file(filename):
     if platform.system() == 'Darwin':  # macOS
         subprocess.call(('open', filename))
@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PROMETHEUS_PREFIX = 'rcc_'
+
+
+def get_key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                    for label, value in labels))
+
+
+class Metrics:
+    """
+    Thread-safe phase timers, counters, gauges and latency summaries of a run of rcc
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the wall time of a phase of the run, a phase entered many times sums up
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def increment(self, name, value=1, labels=None):
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[get_key(name, labels)] = value
+
+    def observe(self, name, seconds, labels=None):
+        """
+        Adds a duration to a summary of its count, sum and max
+        """
+        key = get_key(name, labels)
+        with self.lock:
+            summary = self.summaries.setdefault(key, {'count': 0, 'sum': 0, 'max': 0})
+            summary['count'] += 1
+            summary['sum'] += seconds
+            summary['max'] = max(summary['max'], seconds)
+
+    def to_dict(self):
+        def to_entries(values):
+            return [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(values.items())]
+
+        with self.lock:
+            return {
+                'phases': dict(self.phases),
+                'counters': to_entries(self.counters),
+                'gauges': to_entries(self.gauges),
+                'summaries': to_entries(dict((key, dict(summary)) for key, summary in self.summaries.items())),
+            }
+
+    def to_prometheus(self):
+        """
+        :return string: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            if self.phases:
+                lines.append('# TYPE {}phase_seconds gauge'.format(PROMETHEUS_PREFIX))
+                for name, seconds in sorted(self.phases.items()):
+                    lines.append('{}phase_seconds{} {}'.format(PROMETHEUS_PREFIX, format_labels([('phase', name)]),
+                                                                seconds))
+            for metric_type, suffix, values in (('counter', '_total', self.counters), ('gauge', '', self.gauges)):
+                for metric_name in sorted(set(name for name, _ in values)):
+                    lines.append('# TYPE {}{}{} {}'.format(PROMETHEUS_PREFIX, metric_name, suffix, metric_type))
+                    for (name, labels), value in sorted(values.items()):
+                        if name == metric_name:
+                            lines.append('{}{}{}{} {}'.format(PROMETHEUS_PREFIX, name, suffix,
+                                                              format_labels(labels), value))
+            for metric_name in sorted(set(name for name, _ in self.summaries)):
+                summaries = [(labels, summary) for (name, labels), summary in sorted(self.summaries.items())
+                             if name == metric_name]
+                lines.append('# TYPE {}{}_seconds summary'.format(PROMETHEUS_PREFIX, metric_name))
+                for labels, summary in summaries:
+                    for field in ('count', 'sum'):
+                        lines.append('{}{}_seconds_{}{} {}'.format(PROMETHEUS_PREFIX, metric_name, field,
+                                                                   format_labels(labels), summary[field]))
+                # a summary has no max, it is exposed as a gauge of its own
+                lines.append('# TYPE {}{}_seconds_max gauge'.format(PROMETHEUS_PREFIX, metric_name))
+                for labels, summary in summaries:
+                    lines.append('{}{}_seconds_max{} {}'.format(PROMETHEUS_PREFIX, metric_name,
+                                                                format_labels(labels), summary['max']))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, filename):
+        write_atomically(filename, json.dumps(self.to_dict(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, filename):
+        write_atomically(filename, self.to_prometheus())
+
+
+def write_atomically(filename, content):
+    """
+    Writes a file through a temporary file, so collectors never read a half written file
+    """
+    temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        f.write(content)
+    os.rename(temp_filename, filename)
+
+
+# the metrics of the current run
+registry = Metrics()
+
+
+def write_metrics(json_filename=None, prometheus_filename=None):
+    """
+    Writes the metrics of the current run to the requested files
+    :param string json_filename: optional
+    :param string prometheus_filename: optional - a Prometheus textfile, e.g. for the node exporter
+    :return None:
+    """
+    if json_filename:
+        registry.write_json(json_filename)
+    if prometheus_filename:
+        registry.write_prometheus(prometheus_filename)
@@ -1,5 +1,12 @@
+import re
+from fnmatch import fnmatchcase
 from jinja2 import Template
 
+# compiled templates by their source, compiling is much slower than rendering
+TEMPLATE_CACHE = {}
+# marks a name pattern as a regular expression rather than a glob
+REGEX_PATTERN_PREFIX = 're:'
+
 
 def find_parens(s, open_symbol='{'):
     close_symbol = '}'
@@ -23,10 +30,34 @@ def find_parens(s, open_symbol='{'):
     return to_ret
 
 
+def get_template(content):
+    """
+    Returns the compiled template of a template string, compiling it only once per process
+    """
+    template = TEMPLATE_CACHE.get(content)
+    if template is None:
+        template = TEMPLATE_CACHE[content] = Template(content)
+    return template
+
+
 def render_template_with_variables(content, replacements):
     """
     Renders a string from a template string with replacement variables
     Returns the resulting rendered string
     """
-    template = Template(content)
-    return template.render(**replacements)
+    return get_template(content).render(**replacements)
+
+
+def matches_any(name, patterns):
+    """
+    :param string name:
+    :param list(string) patterns: globs, or regular expressions prefixed with `re:`, matching the whole name
+    :return bool: whether any of the patterns matches the name
+    """
+    for pattern in patterns:
+        if pattern.startswith(REGEX_PATTERN_PREFIX):
+            if re.match('(?:{})$'.format(pattern[len(REGEX_PATTERN_PREFIX):]), name):
+                return True
+        elif fnmatchcase(name, pattern):
+            return True
+    return False
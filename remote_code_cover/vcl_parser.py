@@ -0,0 +1,143 @@
+import re
+
+# whitespaces are skipped in between matches
+TOKEN_PATTERN = re.compile(r'''
+    (?P<comment>\#|//)
+    |(?P<block_comment>/\*)
+    |(?P<long_string>\{(?P<delimiter>[A-Za-z0-9_]*)")
+    |(?P<string>"[^"]*"?)
+    |(?P<word>[A-Za-z_][\w.:-]*)  # a VCL identifier, e.g. `req.http.X-Forwarded-For` or `std.itoa`
+    |(?P<symbol>[{};])
+    |(?P<operator>[^\s{};"\#/A-Za-z_]+|/)
+''', re.VERBOSE)
+
+TOKEN_WORD = 'word'
+TOKEN_STRING = 'string'
+TOKEN_SYMBOL = 'symbol'
+TOKEN_OPERATOR = 'operator'
+
+# tokens after which a new statement starts
+STATEMENT_BOUNDARIES = ('{', '}', ';')
+
+
+class Token:
+    __slots__ = ('kind', 'text', 'column', 'statement_start')
+
+    def __init__(self, kind, text, column, statement_start):
+        self.kind = kind
+        self.text = text
+        self.column = column
+        self.statement_start = statement_start
+
+
+class VclScanner:
+    """
+    A single pass VCL tokenizer working line by line.
+    The state of multi-line long strings (`{"..."}`) and block comments is carried over between lines,
+    comments are dropped and every code token is marked with whether it starts a statement.
+    The line comment of the last scanned line is kept in `comment`, None when it has none
+    """
+
+    def __init__(self):
+        self.long_string_end = None
+        self.in_block_comment = False
+        self.comment = None
+        # the file starts with a new statement
+        self.prev_token_text = ';'
+
+    def in_literal(self):
+        return self.long_string_end is not None or self.in_block_comment
+
+    def scan(self, line):
+        """
+        :param string line: the next line of the file
+        :return bool, list(Token): whether the line starts inside a long string or a block comment,
+        and the code tokens of the line
+        """
+        starts_in_literal = self.in_literal()
+        self.comment = None
+        tokens = []
+        pos = 0
+        length = len(line)
+        while pos < length:
+            if self.in_block_comment:
+                end = line.find('*/', pos)
+                if end == -1:
+                    break
+                self.in_block_comment = False
+                pos = end + 2
+                continue
+
+            if self.long_string_end is not None:
+                end = line.find(self.long_string_end, pos)
+                if end == -1:
+                    break
+                pos = end + len(self.long_string_end)
+                self.long_string_end = None
+                continue
+
+            for match in TOKEN_PATTERN.finditer(line, pos):
+                kind = match.lastgroup
+                if kind == 'comment':
+                    self.comment = line[match.start(kind):]
+                    pos = length
+                    break
+                if kind == 'block_comment':
+                    self.in_block_comment = True
+                    pos = match.end()
+                    break
+
+                text = match.group(kind)
+                tokens.append(Token(TOKEN_STRING if kind == 'long_string' else kind, text, match.start(kind),
+                                    self.prev_token_text in STATEMENT_BOUNDARIES))
+                self.prev_token_text = text if kind == TOKEN_SYMBOL else kind
+                if kind == 'long_string':
+                    self.long_string_end = '"{}}}'.format(match.group('delimiter'))
+                    pos = match.end()
+                    break
+            else:
+                pos = length
+
+        return starts_in_literal, tokens
+
+
+def iter_subroutines(content):
+    """
+    :param string content: VCL code
+    :return generator(string, string): the name and the code of every subroutine the code defines, in order.
+    The code spans from the `sub` line to the line closing the subroutine, trailing whitespaces stripped
+    """
+    scanner = VclScanner()
+    depth = 0
+    expecting_sub_name = False
+    sub_name = None
+    sub_opened = False
+    sub_lines = []
+    for line in content.split('\n'):
+        for token in scanner.scan(line)[1]:
+            if token.kind == TOKEN_SYMBOL and token.text == '{':
+                sub_opened = sub_opened or (depth == 0 and sub_name is not None)
+                depth += 1
+            elif token.kind == TOKEN_SYMBOL and token.text == '}':
+                depth = max(depth - 1, 0)
+            elif token.kind == TOKEN_WORD and depth == 0:
+                if expecting_sub_name:
+                    sub_name = token.text
+                    expecting_sub_name = False
+                elif token.statement_start and token.text == 'sub':
+                    expecting_sub_name = True
+        if sub_name is not None:
+            sub_lines.append(line.rstrip())
+            if sub_opened and depth == 0:
+                yield sub_name, '\n'.join(sub_lines)
+                sub_name = None
+                sub_opened = False
+                sub_lines = []
+
+
+def get_subroutine_names(content):
+    """
+    :param string content: VCL code
+    :return list(string): the names of the subroutines the code defines, in order
+    """
+    return [name for name, _ in iter_subroutines(content)]
@@ -14,7 +14,7 @@ setup(
     description='A CLI tool for code instrumentation and test coverage reporting',
     long_description=open(path.join(CUR_DIR, 'README.md')).read(),
     keywords='perimeterx fastly vcl api instrumentation test-coverage',
-    packages=find_packages(exclude=['contrib', 'docs', 'tests*', 'deploy', 'tmp']),
+    packages=find_packages(exclude=['contrib', 'docs', 'tests*', 'benchmarks*', 'deploy', 'tmp']),
     py_modules=['cli'],
     install_requires=install_requires,
     zip_safe=False,
@@ -0,0 +1,73 @@
+import unittest
+from click.testing import CliRunner
+import cli
+from remote_code_cover import fastly_vcl_cover
+
+VCL = '''sub vcl_recv {
+  set req.http.a = "1";
+  return(lookup);
+}
+'''
+
+
+class FakeFastlyApiClient:
+    """
+    Serves a single active version holding a single custom vcl, and fails the calls changing the service
+    """
+    instances = []
+
+    def __init__(self, auth_token, service_id, api_host=None, max_retries=None, timeout=None):
+        self.service_id = service_id
+        self.changed = False
+        FakeFastlyApiClient.instances.append(self)
+
+    def get_versions(self):
+        return [{'number': 1, 'active': True}]
+
+    def get_active_version(self, versions=None):
+        return 1
+
+    def get_all_custom_vcls(self, version):
+        return [{'name': 'main', 'content': VCL, 'main': True}]
+
+    def clone_version(self, version):
+        self.changed = True
+        raise Exception('The service should not be changed')
+
+    activate_version = clone_version
+
+
+class CoverFastlyTest(unittest.TestCase):
+    def setUp(self):
+        self.fastly_api_client = fastly_vcl_cover.FastlyApiClient
+        fastly_vcl_cover.FastlyApiClient = FakeFastlyApiClient
+        FakeFastlyApiClient.instances = []
+
+    def tearDown(self):
+        fastly_vcl_cover.FastlyApiClient = self.fastly_api_client
+
+    def invoke(self, *args):
+        return CliRunner().invoke(cli.main, ['fastly', '-t', 'x' * 32, '-s', 'service', '--proxy-remote-addr',
+                                             'localhost:5140', '--non-interactive', '--no-cache'] + list(args))
+
+    def test_exceeded_budget_exits_non_zero_without_changing_the_service(self):
+        result = self.invoke('--max-sub-statements', '1')
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('exceeds its budget', result.output)
+        self.assertFalse(any(client.changed for client in FakeFastlyApiClient.instances))
+
+    def test_zero_sample_rate_is_rejected_before_contacting_fastly(self):
+        result = self.invoke('--sample-rate', '0')
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('--sample-rate', result.output)
+        self.assertEqual(FakeFastlyApiClient.instances, [])
+
+
+class OverheadTest(unittest.TestCase):
+    def test_zero_sample_rate_is_rejected(self):
+        result = CliRunner().invoke(cli.main, ['overhead', '--sample-rate', '0', 'tests'])
+        self.assertEqual(result.exit_code, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import json
+import sys
+import threading
+import time
+import unittest
+import requests
+from remote_code_cover.utils import fastly_api_util
+from remote_code_cover.utils.fastly_api_util import FastlyApiClient
+
+if sys.version_info[0] < 3:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+AUTH_TOKEN = 'x' * 32
+SERVICE_ID = 'service'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request with the next scripted response of its method and path, the last one is repeated
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        key = (self.command, self.path.split('?')[0])
+        with self.server.lock:
+            self.server.requests.append(key)
+            responses = self.server.responses[key]
+            status, body, headers, delay = responses.pop(0) if len(responses) > 1 else responses[0]
+        if delay:
+            time.sleep(delay)
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the client gives up on stalled responses, writing them fails
+        pass
+
+
+class FastlyApiClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.responses = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.backoff_base_seconds = fastly_api_util.BACKOFF_BASE_SECONDS
+        fastly_api_util.BACKOFF_BASE_SECONDS = 0.01
+        self.client = FastlyApiClient(AUTH_TOKEN, SERVICE_ID, 'http://127.0.0.1:{}'.format(self.server.server_port),
+                                      max_retries=2, timeout=0.5)
+
+    def tearDown(self):
+        fastly_api_util.BACKOFF_BASE_SECONDS = self.backoff_base_seconds
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def script(self, method, path, *responses):
+        """
+        :param tuple responses: status, body and optionally headers and a delay in seconds
+        """
+        self.server.responses[(method, path)] = [tuple(response) + ({}, 0)[len(response) - 2:]
+                                                 for response in responses]
+
+    def count_requests(self, method, path):
+        return self.server.requests.count((method, path))
+
+    def test_rate_limited_request_is_retried_after_the_retry_after_header(self):
+        versions = [{'number': 1, 'active': True}]
+        self.script('GET', '/service/service/version', (429, {'msg': 'rate limited'}, {'Retry-After': '0'}),
+                    (200, versions))
+        self.assertEqual(self.client.get_versions(), versions)
+        self.assertEqual(self.count_requests('GET', '/service/service/version'), 2)
+
+    def test_server_error_of_idempotent_request_is_retried(self):
+        self.script('GET', '/service/service/version/1/vcl', (503, {'msg': 'unavailable'}),
+                    (502, {'msg': 'bad gateway'}), (200, []))
+        self.assertEqual(self.client.get_all_custom_vcls(1), [])
+        self.assertEqual(self.count_requests('GET', '/service/service/version/1/vcl'), 3)
+
+    def test_server_error_of_post_is_not_retried(self):
+        self.script('POST', '/service/service/version/1/vcl', (500, {'msg': 'failed'}), (200, {}))
+        with self.assertRaises(Exception):
+            self.client.create_custom_vcl(1, {'name': 'main', 'content': '', 'main': 'true'})
+        self.assertEqual(self.count_requests('POST', '/service/service/version/1/vcl'), 1)
+
+    def test_rate_limited_post_is_retried(self):
+        self.script('POST', '/service/service/version/1/logging/syslog',
+                    (429, {'msg': 'rate limited'}, {'Retry-After': '0'}), (200, {'name': 'syslog'}))
+        self.assertEqual(self.client.create_syslog(1, {'name': 'syslog'}), {'name': 'syslog'})
+        self.assertEqual(self.count_requests('POST', '/service/service/version/1/logging/syslog'), 2)
+
+    def test_retries_are_bounded(self):
+        self.script('DELETE', '/service/service/version/1/vcl/main', (503, {'msg': 'unavailable'}))
+        with self.assertRaises(Exception):
+            self.client.delete_custom_vcl(1, 'main')
+        self.assertEqual(self.count_requests('DELETE', '/service/service/version/1/vcl/main'), 3)
+
+    def test_stalled_idempotent_request_times_out_and_is_retried(self):
+        self.script('PUT', '/service/service/version/2', (200, {'number': 2}, {}, 2), (200, {'number': 2}))
+        self.assertEqual(self.client.update_version(2, {'comment': 'rcc'}), {'number': 2})
+        self.assertEqual(self.count_requests('PUT', '/service/service/version/2'), 2)
+
+    def test_stalled_clone_times_out_without_retrying(self):
+        self.script('PUT', '/service/service/version/1/clone', (200, {'number': 2}, {}, 2), (200, {'number': 3}))
+        with self.assertRaises(requests.Timeout):
+            self.client.clone_version(1)
+        self.assertEqual(self.count_requests('PUT', '/service/service/version/1/clone'), 1)
+
+    def test_server_error_of_clone_is_not_retried_but_rate_limited_clone_is(self):
+        self.script('PUT', '/service/service/version/1/clone', (503, {'msg': 'unavailable'}), (200, {'number': 2}))
+        with self.assertRaises(Exception):
+            self.client.clone_version(1)
+        self.assertEqual(self.count_requests('PUT', '/service/service/version/1/clone'), 1)
+        self.script('PUT', '/service/service/version/3/clone', (429, {'msg': 'rate limited'}, {'Retry-After': '0'}),
+                    (200, {'number': 4}))
+        self.assertEqual(self.client.clone_version(3), 4)
+        self.assertEqual(self.count_requests('PUT', '/service/service/version/3/clone'), 2)
+
+    def test_stalled_post_times_out_without_retrying(self):
+        self.script('POST', '/service/service/version/1/vcl', (200, {}, {}, 2))
+        with self.assertRaises(requests.Timeout):
+            self.client.create_custom_vcl(1, {'name': 'main', 'content': '', 'main': 'true'})
+        self.assertEqual(self.count_requests('POST', '/service/service/version/1/vcl'), 1)
+
+    def test_not_found_is_reported(self):
+        self.script('DELETE', '/service/service/version/1/logging/syslog/syslog', (404, {'msg': 'not found'}))
+        self.assertFalse(self.client.delete_syslog(1, 'syslog'))
+        self.script('PUT', '/service/service/version/3/activate', (404, {'msg': 'not found'}))
+        with self.assertRaises(Exception):
+            self.client.activate_version(3)
+
+
+if __name__ == '__main__':
+    unittest.main()
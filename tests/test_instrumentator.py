@@ -0,0 +1,207 @@
+import unittest
+from remote_code_cover.constants import LOG_ENCODING_BITMASK, LOG_ENCODING_LINES
+from remote_code_cover.instrumentator import add_instrumentation
+
+
+def get_tested_line_numbers(content):
+    return add_instrumentation('main', content)[2]
+
+
+def get_log_line(indent, line_numbers):
+    """
+    :return string: the log statement of a subroutine of the `main` file logging these covered lines
+    """
+    return '{}log "syslog " req.service_id " Syslog-Instrumentation :: [INSTR] main," + {};'.format(
+        ' ' * indent, ' + '.join('if(var.log_{0}, "{0} ", "")'.format(line_number) for line_number in line_numbers))
+
+
+class InstrumentationTest(unittest.TestCase):
+    def assert_instrumented(self, lines, expected_lines, log_encoding=LOG_ENCODING_LINES):
+        instrumented_content = add_instrumentation('main', '\n'.join(lines), log_encoding)[0]
+        self.assertEqual(instrumented_content.split('\n'), expected_lines)
+
+    def test_elsif_and_else_lines_are_covered_inside_their_branch(self):
+        self.assert_instrumented([
+            'sub vcl_recv {',
+            '  if (req.http.a) {',
+            '    return(pass);',
+            '  } elsif (req.http.b) {',
+            '    set req.http.c = "1";',
+            '  } else {',
+            '    return(lookup);',
+            '  }',
+            '}',
+        ], [
+            'sub vcl_recv {',
+        ] + ['  declare local var.log_{} BOOL;'.format(line_number) for line_number in range(2, 8)] + [
+            '  set var.log_2 = true;',
+            '  if (req.http.a) {',
+            '    set var.log_3 = true;',
+            get_log_line(4, [2, 3]),
+            '    return(pass);',
+            '  } elsif (req.http.b) {',
+            '    set var.log_4 = true;',
+            '    set var.log_5 = true;',
+            '    set req.http.c = "1";',
+            '  } else {',
+            '    set var.log_6 = true;',
+            '    set var.log_7 = true;',
+            get_log_line(4, range(2, 8)),
+            '    return(lookup);',
+            '  }',
+            get_log_line(2, range(2, 8)),
+            '}',
+        ])
+
+    def test_else_bitmask_bit_is_set_inside_its_branch(self):
+        self.assert_instrumented([
+            'sub vcl_recv {',
+            '  if (req.http.a) {',
+            '    set req.http.b = "1";',
+            '  } else {',
+            '    set req.http.c = "1";',
+            '  }',
+            '}',
+        ], [
+            'sub vcl_recv {',
+            '  declare local var.log_g0 INTEGER;',
+            '  set var.log_g0 |= 1;',
+            '  if (req.http.a) {',
+            '    set var.log_g0 |= 2;',
+            '    set req.http.b = "1";',
+            '  } else {',
+            '    set var.log_g0 |= 4;',
+            '    set var.log_g0 |= 8;',
+            '    set req.http.c = "1";',
+            '  }',
+            '  log "syslog " req.service_id " Syslog-Instrumentation :: [INSTR] main:0:" + std.itoa(var.log_g0, 16);',
+            '}',
+        ], LOG_ENCODING_BITMASK)
+
+    def test_inline_return_logs_ahead_of_it(self):
+        self.assert_instrumented([
+            'sub vcl_recv {',
+            '  if (req.http.a) { return(pass); }',
+            '}',
+        ], [
+            'sub vcl_recv {',
+            '  declare local var.log_2 BOOL;',
+            '  set var.log_2 = true;',
+            '  if (req.http.a) { ' + get_log_line(0, [2]) + ' return(pass); }',
+            get_log_line(2, [2]),
+            '}',
+        ])
+
+    def test_subroutine_brace_on_the_next_line(self):
+        self.assert_instrumented([
+            'sub vcl_recv',
+            '{',
+            '  set req.http.a = "1";',
+            '}',
+        ], [
+            'sub vcl_recv',
+            '{',
+            '  declare local var.log_3 BOOL;',
+            '  set var.log_3 = true;',
+            '  set req.http.a = "1";',
+            get_log_line(2, [3]),
+            '}',
+        ])
+
+    def test_block_comments_are_not_instrumented(self):
+        self.assert_instrumented([
+            'sub vcl_recv {',
+            '  /* set req.http.a = "1";',
+            '  return(pass); */',
+            '  set req.http.b = "1"; /* c */ set req.http.c = "1";',
+            '}',
+        ], [
+            'sub vcl_recv {',
+            '  declare local var.log_4 BOOL;',
+            '  /* set req.http.a = "1";',
+            '  return(pass); */',
+            '  set var.log_4 = true;',
+            '  set req.http.b = "1"; /* c */ set req.http.c = "1";',
+            get_log_line(2, [4]),
+            '}',
+        ])
+
+    def test_multi_line_if_is_a_single_tested_line(self):
+        self.assert_instrumented([
+            'sub vcl_recv {',
+            '  if (req.http.a &&',
+            '      req.http.b) {',
+            '    set req.http.c = "1";',
+            '  }',
+            '}',
+        ], [
+            'sub vcl_recv {',
+            '  declare local var.log_2 BOOL;',
+            '  declare local var.log_4 BOOL;',
+            '  set var.log_2 = true;',
+            '  if (req.http.a &&',
+            '      req.http.b) {',
+            '    set var.log_4 = true;',
+            '    set req.http.c = "1";',
+            '  }',
+            get_log_line(2, [2, 4]),
+            '}',
+        ])
+
+    def test_long_strings_are_not_instrumented(self):
+        self.assert_instrumented([
+            'sub vcl_error {',
+            '  synthetic {"',
+            '  set req.http.a = "1";',
+            '  return(pass);',
+            '  "};',
+            '  return(deliver);',
+            '}',
+        ], [
+            'sub vcl_error {',
+            '  declare local var.log_2 BOOL;',
+            '  declare local var.log_6 BOOL;',
+            '  set var.log_2 = true;',
+            '  synthetic {"',
+            '  set req.http.a = "1";',
+            '  return(pass);',
+            '  "};',
+            '  set var.log_6 = true;',
+            get_log_line(2, [2, 6]),
+            '  return(deliver);',
+            get_log_line(2, [2, 6]),
+            '}',
+        ])
+
+
+class PragmaTest(unittest.TestCase):
+    def test_pragmas_exclude_lines(self):
+        content = '\n'.join([
+            'sub vcl_recv {',
+            '  set req.http.a = "1"; # rcc: ignore',
+            '  # rcc: ignore-start',
+            '  set req.http.b = "1";',
+            '  // rcc: ignore-end',
+            '  set req.http.c = "1";',
+            '}',
+        ])
+        self.assertEqual(get_tested_line_numbers(content), [6])
+
+    def test_pragma_excludes_subroutine(self):
+        content = 'sub vcl_recv { # rcc: ignore\n  set req.http.a = "1";\n}\nsub vcl_deliver {\n  return(deliver);\n}'
+        self.assertEqual(get_tested_line_numbers(content), [5])
+
+    def test_pragma_text_in_strings_is_not_a_pragma(self):
+        content = '\n'.join([
+            'sub vcl_recv {',
+            '  set req.http.a = "rcc: ignore";',
+            '  set req.http.b = "# rcc: ignore-start";',
+            '  set req.http.c = "// rcc: ignore";',
+            '  set req.http.d = {"# rcc: ignore"};',
+            '}',
+        ])
+        self.assertEqual(get_tested_line_numbers(content), [2, 3, 4, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,20 @@
+import unittest
+from remote_code_cover.syslog_receiver import split_frames
+
+
+class SplitFramesTest(unittest.TestCase):
+    def test_newline_framed_messages(self):
+        self.assertEqual(split_frames(b'<13>a\n<13>b\r\n<13>c'), ([b'<13>a', b'<13>b'], b'<13>c'))
+
+    def test_octet_counted_messages(self):
+        self.assertEqual(split_frames(b'5 <13>a7 <13>b\nc5 <13'), ([b'<13>a', b'<13>b\nc'], b'5 <13'))
+
+    def test_octet_count_cut_in_the_middle_waits_for_the_rest(self):
+        self.assertEqual(split_frames(b'<13>a\n12'), ([b'<13>a'], b'12'))
+
+    def test_newline_framed_message_of_digits(self):
+        self.assertEqual(split_frames(b'<13>a\n123\n'), ([b'<13>a', b'123'], b''))
+
+
+if __name__ == '__main__':
+    unittest.main()